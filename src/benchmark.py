@@ -0,0 +1,301 @@
+import contextlib
+import json
+import os
+import pathlib
+import platform
+import shutil
+import tempfile
+import time
+
+from PIL import Image
+import cv2 as cv
+import numpy as np
+
+import blur
+import classifier
+import filter_images
+from fast_svm import load_model
+from hash_index import image_hash
+from params import win_size, cell_size, block_size, block_stride, n_bins
+from preprocess import preprocess
+from training import hog_setup, setup_svm
+
+corpus_dir = 'benchmarks/corpus'
+corpus_sizes = ((1280, 720), (1920, 1080))
+corpus_formats = ('jpg', 'png')
+n_images = 32
+seed = 0
+predict_batch_sizes = (1, 16, 64, 256)
+repeats = 3
+svm_path = None  # None to train a model on the corpus
+svm_C = 1.0
+svm_gamma = 1e-2
+results_path = 'benchmarks/results.json'
+baseline_path = 'benchmarks/baseline.json'
+update_baseline = False
+regression_threshold = 0.1
+
+
+def synthetic_image(rng, size, positive, blurred=False):
+    # Letterboxed frame with a textured background and a rectangle
+    # (positive) or a disc (negative) at a random place
+    w, h = size
+    im = np.zeros((h, w, 3), np.uint8)
+    x0 = int(rng.integers(0, w // 8))
+    y0 = int(rng.integers(0, h // 8))
+    x1 = w - int(rng.integers(0, w // 8))
+    y1 = h - int(rng.integers(0, h // 8))
+    noise = rng.integers(20, 80, (y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    im[y0:y1, x0:x1] = noise
+    cx = int(rng.integers(x0 + w // 4, x1 - w // 4))
+    cy = int(rng.integers(y0 + h // 4, y1 - h // 4))
+    color = tuple(int(c) for c in rng.integers(100, 256, 3))
+    if positive:
+        cv.rectangle(im, (cx - w // 5, cy - h // 5),
+                     (cx + w // 5, cy + h // 5), color, max(2, w // 64))
+    else:
+        cv.circle(im, (cx, cy), h // 4, color, -1)
+    if blurred:
+        im = cv.GaussianBlur(im, (0, 0), w / 160)
+    return im
+
+
+def corpus_path(size, image_format):
+    return os.path.join(corpus_dir, f'{image_format}_{size[0]}x{size[1]}')
+
+
+def generate_corpus(size, image_format, n=32, seed=0):
+    # Returns [(path, label)]. Every fourth image is blurred and every
+    # eighth repeats the previous one, so the filters have work to do.
+    directory = pathlib.Path(corpus_path(size, image_format))
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    items = []
+    for i in range(n):
+        path = directory / f'img{i:04d}.{image_format}'
+        if i % 8 != 7:
+            positive = i % 2 == 1
+            im = synthetic_image(rng, size, positive, i % 4 == 3)
+        if not path.is_file():
+            cv.imwrite(str(path), im)
+        items.append((str(path), 1 if positive else -1))
+    return items
+
+
+def summary(latencies, n_items=None):
+    latencies = np.asarray(latencies)
+    total = float(latencies.sum())
+    n_items = len(latencies) if n_items is None else n_items
+    return {
+        'count': n_items,
+        'throughput': n_items / total if total else None,
+        'p50_ms': float(np.percentile(latencies, 50)) * 1000,
+        'p99_ms': float(np.percentile(latencies, 99)) * 1000,
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def timed(function, items):
+    # Latency of function(item) for every item, after a warm up call
+    function(items[0])
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(results, name, stats):
+    results[name] = stats
+    print(f'{name}'.ljust(40) + f'{stats["throughput"]:12.1f}/s' +
+          f'{stats["p50_ms"]:10.2f}ms' + f'{stats["p99_ms"]:10.2f}ms')
+
+
+def corpus_model(features, labels):
+    if svm_path is not None:
+        return load_model(svm_path)
+    svm = setup_svm(svm_C, svm_gamma)
+    svm.train(features, cv.ml.ROW_SAMPLE, np.int32(labels).reshape(-1, 1))
+    return svm
+
+
+def bench_images(results, prefix, paths, hog):
+    report(results, f'{prefix}/decode', summary(timed(cv.imread, paths)))
+    images = [cv.imread(p) for p in paths]
+    report(results, f'{prefix}/preprocess',
+           summary(timed(lambda im: preprocess(im, hog.winSize), images)))
+    cropped = [preprocess(im, hog.winSize) for im in images]
+    kept = [i for i, im in enumerate(cropped) if im is not None]
+    cropped = [cropped[i] for i in kept]
+    report(results, f'{prefix}/hog_compute',
+           summary(timed(hog.compute, cropped)))
+    features = np.float32([hog.compute(im) for im in cropped])
+    return features.reshape(len(cropped), -1), kept
+
+
+def bench_predict(results, svm, features):
+    for batch_size in predict_batch_sizes:
+        batch = np.resize(features, (batch_size, features.shape[1]))
+        latencies = timed(svm.predict, [batch] * repeats)
+        report(results, f'svm_predict/batch_{batch_size}',
+               summary(latencies, batch_size * repeats))
+
+
+def bench_filters(results, prefix, paths):
+    report(
+        results, f'{prefix}/filter_hash',
+        summary(
+            timed(
+                lambda p: image_hash(Image.open(p), filter_images.hash_kind),
+                paths)))
+    report(
+        results, f'{prefix}/filter_blurred',
+        summary(
+            timed(
+                lambda p: blur.score_file(p, filter_images.blur_backend,
+                                          filter_images.blur_reduction),
+                paths)))
+    report(
+        results, f'{prefix}/filter_contrast',
+        summary(timed(lambda p: filter_images.entropy(cv.imread(p, 0)),
+                      paths)))
+    report(
+        results, f'{prefix}/image_metrics',
+        summary(
+            timed(
+                lambda p: filter_images.image_metrics(
+                    p, filter_images.hash_kind, filter_images.blur_backend,
+                    filter_images.blur_reduction), paths)))
+
+    # Every filter on a copy of the corpus, as `filter_images.py` runs them
+    latencies = []
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as directory:
+            for p in paths:
+                shutil.copy(p, directory)
+            start = time.perf_counter()
+            with quiet():
+                filter_directory_all(directory)
+            latencies.append(time.perf_counter() - start)
+    report(results, f'{prefix}/filter_directory',
+           summary(latencies, len(paths) * repeats))
+
+
+def filter_directory_all(directory):
+    filter_images.filter_directory(directory,
+                                   filter_images.contrast_threshold,
+                                   blur_threshold=5,
+                                   remove_outliers=True,
+                                   max_hash_distance=2,
+                                   hash_kind=filter_images.hash_kind,
+                                   blur_backend=filter_images.blur_backend,
+                                   blur_reduction=filter_images.blur_reduction)
+
+
+def bench_classifier(results, prefix, paths, hog, svm):
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with quiet():
+            classifier.classify(iter(paths), hog, svm, classifier.batch_size,
+                                False)
+        latencies.append(time.perf_counter() - start)
+    report(results, f'{prefix}/classifier',
+           summary(latencies, len(paths) * repeats))
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'opencv': cv.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'corpus': {
+            'sizes': [list(s) for s in corpus_sizes],
+            'formats': list(corpus_formats),
+            'images': n_images,
+            'seed': seed,
+        },
+        'hog': {
+            'win_size': list(win_size),
+            'cell_size': list(cell_size),
+            'block_size': list(block_size),
+            'block_stride': list(block_stride),
+            'n_bins': n_bins,
+        },
+    }
+
+
+def run():
+    hog = hog_setup(win_size, cell_size, n_bins, block_size, block_stride)
+    results = {}
+    svm = None
+    print('Benchmark'.ljust(40) + 'throughput'.rjust(14) + 'p50'.rjust(12) +
+          'p99'.rjust(12))
+    for image_format in corpus_formats:
+        for size in corpus_sizes:
+            items = generate_corpus(size, image_format, n_images, seed)
+            paths = [p for p, _ in items]
+            prefix = f'{image_format}_{size[0]}x{size[1]}'
+            features, kept = bench_images(results, prefix, paths, hog)
+            if svm is None:
+                labels = [items[i][1] for i in kept]
+                svm = corpus_model(features, labels)
+                bench_predict(results, svm, features)
+            bench_filters(results, prefix, paths)
+            bench_classifier(results, prefix, paths, hog, svm)
+    return {'environment': environment(), 'results': results}
+
+
+def compare(current, baseline, threshold=0.1):
+    # Throughput change of each benchmark present on both. Returns the names
+    # slower than the baseline by more than `threshold`.
+    if current['environment'] != baseline['environment']:
+        print('Baseline was measured on another environment or settings.')
+    print('Benchmark'.ljust(40) + 'baseline'.rjust(14) + 'current'.rjust(14) +
+          'change'.rjust(10))
+    slower = []
+    for name, stats in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['throughput']
+        after = stats['throughput']
+        if not before or not after:
+            continue
+        change = after / before - 1
+        mark = ''
+        if change < -threshold:
+            slower.append(name)
+            mark = ' slower'
+        print(f'{name}'.ljust(40) + f'{before:12.1f}/s' + f'{after:12.1f}/s' +
+              f'{change * 100:+9.1f}%' + mark)
+    return slower
+
+
+def save(results, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    current = run()
+    save(current, results_path)
+    print(f'Results saved at {results_path}')
+    if update_baseline or not os.path.isfile(baseline_path):
+        save(current, baseline_path)
+        print(f'Baseline saved at {baseline_path}')
+    else:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        slower = compare(current, baseline, regression_threshold)
+        if slower:
+            print(f'{len(slower)} benchmarks slower than the baseline.')
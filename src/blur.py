@@ -0,0 +1,104 @@
+import pathlib
+
+import cv2 as cv
+import numpy as np
+import scipy.fft
+
+reduced_flags = {
+    1: cv.IMREAD_GRAYSCALE,
+    2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def fft_score(im, size=60):
+    # Mean log magnitude of the image without its lowest frequencies, the
+    # 2 * size square centred on the shifted spectrum. It is zeroed on the
+    # corners of the unshifted complex64 spectrum instead of shifting it.
+    # That square is not symmetric, so the full complex spectrum is needed
+    # to keep the scores (and thresholds) of the original method.
+    h, w = im.shape
+    spectrum = scipy.fft.fft2(np.float32(im), workers=1)
+    for rows in (slice(0, size), slice(h - size, h)):
+        for cols in (slice(0, size), slice(w - size, w)):
+            spectrum[rows, cols] = 0
+    recon = scipy.fft.ifft2(spectrum, workers=1)
+    # Exact zeros are rare, but would make the mean -inf
+    magnitude = 20 * np.log(np.maximum(np.abs(recon), 1e-3))
+    return float(np.mean(magnitude))
+
+
+def laplacian_score(im, size=None):
+    return float(cv.Laplacian(im, cv.CV_32F).var())
+
+
+def tenengrad_score(im, size=None):
+    gx = cv.Sobel(im, cv.CV_32F, 1, 0, ksize=3)
+    gy = cv.Sobel(im, cv.CV_32F, 0, 1, ksize=3)
+    return float(np.mean(gx * gx + gy * gy))
+
+
+backends = {
+    'fft': fft_score,
+    'laplacian': laplacian_score,
+    'tenengrad': tenengrad_score,
+}
+
+
+def blur_score(im, backend='fft', reduction=1, size=60):
+    # `im` is a grayscale image already reduced by `reduction`. Lower
+    # scores are blurrier for every backend.
+    return backends[backend](im, max(1, size // reduction))
+
+
+def read_gray(img_path, reduction=1):
+    return cv.imread(img_path, reduced_flags[reduction])
+
+
+def reduce(im, reduction=1):
+    if reduction == 1:
+        return im
+    h, w = im.shape
+    return cv.resize(im, (w // reduction, h // reduction),
+                     interpolation=cv.INTER_AREA)
+
+
+def score_file(img_path, backend='fft', reduction=1, size=60):
+    return blur_score(read_gray(img_path, reduction), backend, reduction, size)
+
+
+def calibrate(source_scores, target_scores, threshold):
+    # Maps `threshold` of the source scores to the target scores of the same
+    # images, so that both consider the same number of images blurry.
+    # Returns the target threshold and the fraction of images on which both
+    # agree.
+    source_scores = np.asarray(source_scores)
+    target_scores = np.asarray(target_scores)
+    blurry = np.count_nonzero(source_scores <= threshold)
+    ordered = np.sort(target_scores)
+    if blurry == 0:
+        target_threshold = np.nextafter(ordered[0], -np.inf)
+    elif blurry == len(ordered):
+        target_threshold = ordered[-1]
+    else:
+        target_threshold = (ordered[blurry - 1] + ordered[blurry]) / 2
+    agreement = np.mean((source_scores <= threshold) == (
+        target_scores <= target_threshold))
+    return float(target_threshold), float(agreement)
+
+
+if __name__ == '__main__':
+    imgs = sorted(
+        str(p) for p in pathlib.Path('images/undefined').iterdir()
+        if p.suffix in ('.jpg', '.png'))
+    threshold = 5
+    source_scores = [score_file(p, 'fft', 1) for p in imgs]
+    print(f'Thresholds equivalent to fft threshold {threshold}:')
+    for backend in backends:
+        for reduction in reduced_flags:
+            target_scores = [score_file(p, backend, reduction) for p in imgs]
+            target_threshold, agreement = calibrate(source_scores,
+                                                    target_scores, threshold)
+            print(f'{backend} (1/{reduction}): {target_threshold:.4g} ' +
+                  f'({agreement * 100:.1f}% agreement)')
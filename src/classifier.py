@@ -1,62 +1,386 @@
+import itertools
 import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2 as cv
 import numpy as np
+from PIL import Image
 
-hog = cv.HOGDescriptor('models/hog_model.xml')
-svm = cv.ml.SVM.load('models/svm_model.dat')
+import instrument
+from decode import DecodeMode, load_mode
+from fast_svm import CascadeModel, input_len, load_model, load_prefilter
+from hash_index import hamming_distance, image_hash
+from preprocess import preprocess_batch
+from projection import ProjectedModel, load_projection
 
-win_size = hog.winSize
-cell_size = hog.cellSize
+engine = 'exact'  # 'exact', 'approx' or 'reduced'
+engine_paths = {
+    'exact': 'models/svm_model.dat',
+    'approx': 'models/svm_approx.npz',
+    'reduced': 'models/svm_reduced.npz',
+}
+batch_size = 256
+visual = True
+visual_format = None  # 'png', 'jpg' or None to keep the input format
+jpeg_quality = 95
+png_compression = 1
+render_workers = os.cpu_count()
+render_backlog = 2  # images waiting or being rendered per render worker
+projection_path = 'models/pca_model.npz'
+cascade = False  # decide clear samples with the linear prefilter alone
+prefilter_path = 'models/svm_prefilter.npz'
+frame_stride = 1  # classify every frame_stride-th frame of videos
+skip_unchanged = False  # skip frames with the average hash of the last one
+unchanged_distance = 0
+video_output = 'frames'  # 'frames' or 'segments' of frames with same label
 
-file_paths = []
-features = []
-while True:
-    try:
-        file_path = os.path.abspath(input())
-        if file_path and not os.path.exists(file_path):
-            print(f'File {file_path} do not exists.')
+
+def load_models(hog_path='models/hog_model.xml',
+                svm_path='models/svm_model.dat',
+                projection_path=projection_path,
+                prefilter_path=None):
+    # Models trained on projected features are wrapped with the projection
+    # saved with them, and with the linear prefilter on `prefilter_path`.
+    # Images are decoded in the mode saved with the HOG.
+    hog = cv.HOGDescriptor(hog_path)
+    mode = load_mode(hog_path)
+    svm = load_model(svm_path)
+    descriptor_len = hog.getDescriptorSize()
+    prefilter = load_prefilter(prefilter_path) if prefilter_path else None
+    if prefilter is not None and len(prefilter.weights) != descriptor_len:
+        raise ValueError(f'{prefilter_path} expects ' +
+                         f'{len(prefilter.weights)} features, but ' +
+                         f'{hog_path} computes {descriptor_len}')
+    model_len = input_len(svm)
+    if model_len == descriptor_len:
+        return hog, with_prefilter(svm, prefilter), mode
+    if projection_path and os.path.isfile(projection_path):
+        projection = load_projection(projection_path)
+        if (projection.input_len, projection.n_components) == (descriptor_len,
+                                                               model_len):
+            svm = ProjectedModel(projection, svm)
+            return hog, with_prefilter(svm, prefilter), mode
+    raise ValueError(f'{svm_path} expects {model_len} features, but ' +
+                     f'{hog_path} computes {descriptor_len} and no ' +
+                     f'projection on {projection_path} matches')
+
+
+def with_prefilter(model, prefilter):
+    return model if prefilter is None else CascadeModel(prefilter, model)
+
+
+def read_paths(stream):
+    for line in stream:
+        yield os.path.abspath(line.rstrip('\n'))
+
+
+def load_image(file_path, mode):
+    if file_path and not os.path.exists(file_path):
+        print(f'File {file_path} do not exists.')
+        return None
+    im = mode.imread(file_path)
+    if im is None:
+        print(f'Opencv do not opened {file_path}. ' +
+              'Maybe it is not a image.')
+        return None
+    return im
+
+
+def batch_features(file_batch, decoded, hog, keep_images=False, names=None):
+    # Crops the decoded images of a batch together, as in training. `names`
+    # describe the images on messages, their paths by default.
+    paths = []
+    features = []
+    images = []
+    with instrument.span('preprocess'):
+        cropped = preprocess_batch(decoded, hog.winSize)
+    for i, (file_path, im) in enumerate(zip(file_batch, cropped)):
+        if im is None:
+            name = file_path if names is None else names[i]
+            print(f'{name} ignored because is darker')
+            instrument.count('ignored')
             continue
-        im = cv.imread(file_path)
+        paths.append(file_path)
+        with instrument.span('hog_compute'):
+            features.append(hog.compute(im))
+        if keep_images:
+            images.append(im)
+    if not features:
+        return paths, np.empty((0, hog.getDescriptorSize()),
+                               np.float32), images
+    return paths, np.float32(features).reshape(len(features), -1), images
+
+
+def batches(file_paths, hog, batch_size, keep_images=False, mode=None):
+    mode = mode or DecodeMode()
+    file_batch = []
+    decoded = []
+    for file_path in file_paths:
+        im = load_image(file_path, mode)
         if im is None:
-            print(f'Opencv do not opened {file_path}. ' +
-                  'Maybe it is not a image.')
             continue
-        assert (im.shape[:2][::-1] == win_size)
-        features.append(hog.compute(im))
-        file_paths.append(file_path)
-    except EOFError:
-        break
+        file_batch.append(file_path)
+        decoded.append(im)
+        if len(file_batch) == batch_size:
+            batch = batch_features(file_batch, decoded, hog, keep_images)
+            if batch[0]:
+                yield batch
+            file_batch = []
+            decoded = []
+    if file_batch:
+        batch = batch_features(file_batch, decoded, hog, keep_images)
+        if batch[0]:
+            yield batch
 
-features = np.float32(features).reshape(-1, len(features[0]))
-result = svm.predict(features)[1]
 
-visual = True
+def prefetch(iterable, size=1):
+    # Consumes iterable on a background thread, at most `size` items ahead.
+    # Closing the generator stops the thread and waits for it to exit.
+    items = queue.Queue(size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is end:
+                break
+            yield item
+    finally:
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def visual_path(file_path, visual_format=None):
+    name = os.path.basename(file_path)
+    if visual_format:
+        name = f'{os.path.splitext(name)[0]}.{visual_format}'
+    return os.path.join('results', name)
+
+
+def write_params(path):
+    if path.endswith('.png'):
+        return [cv.IMWRITE_PNG_COMPRESSION, png_compression]
+    if path.endswith('.jpg') or path.endswith('.jpeg'):
+        return [cv.IMWRITE_JPEG_QUALITY, jpeg_quality]
+    return []
 
-if visual:
-    if not os.path.exists('results'):
-        os.makedirs('results/')
 
-print('Results:')
-for file_path, label in zip(file_paths, result):
-    is_positive = label[0] == 1
-    print(f'{file_path}'.ljust(70) + f'{is_positive}'.rjust(10))
+def render(im, file_path, is_positive, win_size, cell_size):
+    gx = cv.Sobel(im, cv.CV_32F, 1, 0, ksize=1)
+    gy = cv.Sobel(im, cv.CV_32F, 0, 1, ksize=1)
+    mag, _ = cv.cartToPolar(gx, gy, angleInDegrees=True)
+    mag = mag.astype('uint8')
 
+    cv.putText(im, 'POSITIVE' if is_positive else 'NEGATIVE', (100, 100),
+               cv.FONT_HERSHEY_SIMPLEX, 2,
+               (0, 255, 0, 255) if is_positive else (0, 0, 255, 255), 3)
+    for x in range(cell_size[0], win_size[0], cell_size[0]):
+        cv.line(mag, (x, 0), (x, win_size[1] - 1), (0, 0, 0, 0), 3)
+        cv.line(mag, (x, 0), (x, win_size[1] - 1), (0, 255, 255, 0), 1)
+    for y in range(cell_size[1], win_size[1], cell_size[1]):
+        cv.line(mag, (0, y), (win_size[0] - 1, y), (0, 0, 0, 0), 3)
+        cv.line(mag, (0, y), (win_size[0] - 1, y), (0, 255, 255, 0), 1)
+    path = visual_path(file_path, visual_format)
+    with instrument.span('imwrite'):
+        cv.imwrite(path, np.concatenate((im, mag), axis=1),
+                   write_params(path))
+
+
+def submit_render(renderer, backlog, *args):
+    # Blocks while the backlog is full
+    backlog.acquire()
+    future = renderer.submit(render, *args)
+    future.add_done_callback(lambda _: backlog.release())
+    return future
+
+
+def pending(futures):
+    # Futures not done yet, raising the error of any failed one
+    remaining = []
+    for future in futures:
+        if future.done():
+            future.result()
+        else:
+            remaining.append(future)
+    return remaining
+
+
+def classify(file_paths, hog, svm, batch_size=256, visual=False, mode=None):
     if visual:
-        im = cv.imread(file_path)
-        gx = cv.Sobel(im, cv.CV_32F, 1, 0, ksize=1)
-        gy = cv.Sobel(im, cv.CV_32F, 0, 1, ksize=1)
-        mag, _ = cv.cartToPolar(gx, gy, angleInDegrees=True)
-        mag = mag.astype('uint8')
-
-        cv.putText(im, 'POSITIVE' if is_positive else 'NEGATIVE', (100, 100),
-                   cv.FONT_HERSHEY_SIMPLEX, 2,
-                   (0, 255, 0, 255) if is_positive else (0, 0, 255, 255), 3)
-        for x in range(cell_size[0], win_size[0], cell_size[0]):
-            cv.line(mag, (x, 0), (x, win_size[1] - 1), (0, 0, 0, 0), 3)
-            cv.line(mag, (x, 0), (x, win_size[1] - 1), (0, 255, 255, 0), 1)
-        for y in range(cell_size[1], win_size[1], cell_size[1]):
-            cv.line(mag, (0, y), (win_size[0] - 1, y), (0, 0, 0, 0), 3)
-            cv.line(mag, (0, y), (win_size[0] - 1, y), (0, 255, 255, 0), 1)
-        cv.imwrite(f'results/{os.path.basename(file_path)}',
-                   np.concatenate((im, mag), axis=1))
+        if not os.path.exists('results'):
+            os.makedirs('results/')
+        renderer = ThreadPoolExecutor(render_workers)
+        backlog = threading.BoundedSemaphore(render_workers * render_backlog)
+    rendering = []
+
+    print('Results:')
+    for file_batch, features, images in prefetch(
+            batches(file_paths, hog, batch_size, visual, mode)):
+        with instrument.span('predict'):
+            result = svm.predict(features)[1]
+        instrument.count('images', len(file_batch))
+        for file_path, label in zip(file_batch, result):
+            is_positive = label[0] == 1
+            print(f'{file_path}'.ljust(70) + f'{is_positive}'.rjust(10))
+        sys.stdout.flush()
+
+        if visual:
+            # Images are released from the batch as they are submitted, so
+            # at most the backlog outlives it
+            for i, (file_path, label) in enumerate(zip(file_batch, result)):
+                im, images[i] = images[i], None
+                rendering.append(
+                    submit_render(renderer, backlog, im, file_path,
+                                  label[0] == 1, hog.winSize, hog.cellSize))
+            rendering = pending(rendering)
+
+    if visual:
+        renderer.shutdown()
+        for future in rendering:
+            future.result()
+    if isinstance(svm, CascadeModel):
+        print(f'{svm.forwarded} of {svm.samples} images ' +
+              f'({svm.forwarded_fraction * 100:.1f}%) sent to the RBF model',
+              file=sys.stderr)
+
+
+def open_capture(source):
+    # Video file, stream URL or camera index
+    capture = cv.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        print(f'Opencv do not opened {source}. Maybe it is not a video.')
+        return None
+    return capture
+
+
+def read_frames(capture,
+                mode,
+                stride=1,
+                skip_unchanged=False,
+                unchanged_distance=0):
+    # Yields (timestamp in seconds, frame in `mode`) of every `stride`-th
+    # frame. Frames skipped by the stride are grabbed but not decoded.
+    fps = capture.get(cv.CAP_PROP_FPS)
+    last_hash = None
+    for index in itertools.count():
+        if index % stride:
+            if not capture.grab():
+                break
+            continue
+        with instrument.span('decode'):
+            grabbed, frame = capture.read()
+        if not grabbed:
+            break
+        timestamp = (index / fps if fps > 0 else
+                     capture.get(cv.CAP_PROP_POS_MSEC) / 1000)
+        if skip_unchanged:
+            with instrument.span('hash'):
+                small = cv.resize(frame, (32, 32),
+                                  interpolation=cv.INTER_AREA)
+                h = image_hash(Image.fromarray(small), 'ahash')
+            if last_hash is not None and hamming_distance(
+                    h, last_hash) <= unchanged_distance:
+                instrument.count('frames_unchanged')
+                continue
+            last_hash = h
+        yield timestamp, mode.convert(frame)
+
+
+def print_segment(segment):
+    if segment is not None:
+        start, end, is_positive = segment
+        print(f'{start:10.3f} {end:10.3f}' + f'{is_positive}'.rjust(10))
+
+
+def classify_video(source,
+                   hog,
+                   svm,
+                   batch_size=256,
+                   mode=None,
+                   stride=1,
+                   skip_unchanged=False,
+                   unchanged_distance=0,
+                   output='frames'):
+    # Frames are decoded on a background thread, at most a batch ahead,
+    # while the previous batch is computed and predicted
+    capture = open_capture(source)
+    if capture is None:
+        return
+    frames = prefetch(
+        read_frames(capture, mode or DecodeMode(), stride, skip_unchanged,
+                    unchanged_distance), batch_size)
+    segment = None
+    print(f'Results of {source}:')
+    try:
+        while True:
+            batch = list(itertools.islice(frames, batch_size))
+            if not batch:
+                break
+            timestamps, features, _ = batch_features(
+                [t for t, _ in batch], [im for _, im in batch],
+                hog,
+                names=[f'{source} at {t:.3f}s' for t, _ in batch])
+            if not timestamps:
+                continue
+            with instrument.span('predict'):
+                result = svm.predict(features)[1]
+            instrument.count('frames', len(timestamps))
+            for timestamp, label in zip(timestamps, result):
+                is_positive = label[0] == 1
+                if output == 'frames':
+                    print(f'{timestamp:10.3f}' + f'{is_positive}'.rjust(10))
+                elif segment is not None and segment[2] == is_positive:
+                    segment[1] = timestamp
+                else:
+                    print_segment(segment)
+                    segment = [timestamp, timestamp, is_positive]
+            sys.stdout.flush()
+        print_segment(segment)
+    finally:
+        # The decoding thread must be out of the capture before release
+        frames.close()
+        capture.release()
+
+
+if __name__ == '__main__':
+    hog, svm, mode = load_models(
+        svm_path=engine_paths[engine],
+        prefilter_path=prefilter_path if cascade else None)
+    if len(sys.argv) > 1:
+        for source in sys.argv[1:]:
+            classify_video(source, hog, svm, batch_size, mode, frame_stride,
+                           skip_unchanged, unchanged_distance, video_output)
+    else:
+        classify(read_paths(sys.stdin), hog, svm, batch_size, visual, mode)
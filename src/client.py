@@ -0,0 +1,43 @@
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+url = 'http://127.0.0.1:8080/classify'
+n_connections = 8
+
+
+def post(data, content_type, url='http://127.0.0.1:8080/classify'):
+    request = urllib.request.Request(url,
+                                     data=data,
+                                     headers={'Content-Type': content_type})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read())
+
+
+def classify_paths(paths, url='http://127.0.0.1:8080/classify'):
+    data = json.dumps({'paths': paths}).encode()
+    return post(data, 'application/json', url)['results']
+
+
+def classify_bytes(data, url='http://127.0.0.1:8080/classify'):
+    return post(data, 'application/octet-stream', url)
+
+
+if __name__ == '__main__':
+    paths = [os.path.abspath(line.rstrip('\n')) for line in sys.stdin]
+    # One request per image, so the server groups them into micro-batches
+    with ThreadPoolExecutor(n_connections) as executor:
+        results = executor.map(lambda p: classify_paths([p], url)[0], paths)
+        print('Results:')
+        for result in results:
+            if 'error' in result:
+                print(f'{result["path"]}: {result["error"]}')
+            else:
+                print(f'{result["path"]}'.ljust(70) +
+                      f'{result["positive"]}'.rjust(10))
@@ -0,0 +1,80 @@
+import numpy as np
+
+percent_cut = 0.75
+load_chunk = 1024
+
+
+def stratified_split(labels, cut=percent_cut, seed=0):
+    # Shuffled indices of the training and test samples, with `cut` of the
+    # samples of each label on the training split
+    rng = np.random.default_rng(seed)
+    labels = np.ravel(labels)
+    train_index = []
+    test_index = []
+    for label in np.unique(labels):
+        index = np.flatnonzero(labels == label)
+        rng.shuffle(index)
+        train_len = int(len(index) * cut)
+        train_index.append(index[:train_len])
+        test_index.append(index[train_len:])
+    return (np.concatenate(train_index or [np.empty(0, np.intp)]),
+            np.concatenate(test_index or [np.empty(0, np.intp)]))
+
+
+def allocate(n, feature_len, path=None):
+    # Array of (n, feature_len) float32 on memory or memory mapped on the
+    # .npy file `path`
+    if path is None:
+        return np.empty((n, feature_len), np.float32)
+    return np.lib.format.open_memmap(path,
+                                     mode='w+',
+                                     dtype=np.float32,
+                                     shape=(n, feature_len))
+
+
+class Dataset:
+    # Samples on a single (n, feature_len) float32 array and their labels
+    # on a (n, 1) int32 array. Rows are kept in split order, the training
+    # samples first, so the splits are views of the arrays and not copies.
+
+    def __init__(self, data, labels, n_train):
+        self.data = data
+        self.labels = labels
+        self.n_train = n_train
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def feature_len(self):
+        return self.data.shape[1]
+
+    @property
+    def train_data(self):
+        return self.data[:self.n_train]
+
+    @property
+    def train_labels(self):
+        return self.labels[:self.n_train]
+
+    @property
+    def test_data(self):
+        return self.data[self.n_train:]
+
+    @property
+    def test_labels(self):
+        return self.labels[self.n_train:]
+
+    @classmethod
+    def from_rows(cls, source, rows, labels, path=None, cut=percent_cut):
+        # Copies the `rows` of the `source` matrix (e.g. a feature store
+        # memory map), labelled by `labels`, in `load_chunk` rows at a time
+        train_index, test_index = stratified_split(labels, cut)
+        order = np.concatenate([train_index, test_index])
+        rows = np.asarray(rows, np.intp)[order]
+        data = allocate(len(rows), source.shape[1], path)
+        for start in range(0, len(rows), load_chunk):
+            chunk = rows[start:start + load_chunk]
+            data[start:start + len(chunk)] = source[chunk]
+        labels = np.int32(labels).reshape(-1, 1)[order]
+        return cls(data, labels, len(train_index))
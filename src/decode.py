@@ -0,0 +1,96 @@
+import cv2 as cv
+import numpy as np
+
+import instrument
+from params import win_size, cell_size, block_size, block_stride
+
+color_flags = {
+    1: cv.IMREAD_COLOR,
+    2: cv.IMREAD_REDUCED_COLOR_2,
+    4: cv.IMREAD_REDUCED_COLOR_4,
+    8: cv.IMREAD_REDUCED_COLOR_8,
+}
+gray_flags = {
+    1: cv.IMREAD_GRAYSCALE,
+    2: cv.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv.IMREAD_REDUCED_GRAYSCALE_8,
+}
+mode_node = 'decode_mode'
+
+
+class DecodeMode:
+    # Images decoded in colour or grayscale, reduced by 1, 2, 4 or 8 by the
+    # decoder (JPEG images are decoded at the reduced size). Written as
+    # 'color/1', 'gray/2', ... HOG of grayscale images computes the
+    # gradients of one channel instead of three.
+
+    def __init__(self, gray=False, reduction=1):
+        if reduction not in color_flags:
+            raise ValueError(
+                f'reduction must be 1, 2, 4 or 8, not {reduction}')
+        self.gray = gray
+        self.reduction = reduction
+
+    @classmethod
+    def parse(cls, text):
+        name, _, reduction = text.partition('/')
+        if name not in ('color', 'gray') or not (reduction or '1').isdigit():
+            raise ValueError(f'unknown decode mode {text}')
+        return cls(name == 'gray', int(reduction or 1))
+
+    def __str__(self):
+        return f'{"gray" if self.gray else "color"}/{self.reduction}'
+
+    @property
+    def flags(self):
+        return (gray_flags if self.gray else color_flags)[self.reduction]
+
+    def imread(self, path):
+        return instrument.imread(path, self.flags)
+
+    def imdecode(self, data):
+        return cv.imdecode(np.frombuffer(data, np.uint8), self.flags)
+
+    def convert(self, im):
+        # Colour image at full size, e.g. a video frame, as if it had been
+        # decoded in this mode
+        if self.reduction > 1:
+            h, w = im.shape[:2]
+            im = cv.resize(im, (w // self.reduction, h // self.reduction),
+                           interpolation=cv.INTER_AREA)
+        if self.gray and im.ndim == 3:
+            im = cv.cvtColor(im, cv.COLOR_BGR2GRAY)
+        return im
+
+    def description(self):
+        # Part of the feature store key. The default mode adds nothing, so
+        # stores extracted before the modes are kept.
+        if not self.gray and self.reduction == 1:
+            return {}
+        return {'decode': str(self)}
+
+    def geometry(self):
+        # (win_size, cell_size, block_size, block_stride) of params.py
+        # scaled down by the reduction
+        sizes = (win_size, cell_size, block_size, block_stride)
+        r = self.reduction
+        if any(w % r or h % r for w, h in sizes):
+            raise ValueError(
+                f'HOG geometry of params.py can not be reduced by {r}')
+        return tuple((w // r, h // r) for w, h in sizes)
+
+    def save(self, hog_path):
+        # Written on the HOG model file, after the descriptor
+        fs = cv.FileStorage(hog_path, cv.FILE_STORAGE_APPEND)
+        fs.write(mode_node, str(self))
+        fs.release()
+
+
+def load_mode(hog_path):
+    # HOG models saved without a mode were trained on colour images
+    fs = cv.FileStorage(hog_path, cv.FILE_STORAGE_READ)
+    node = fs.getNode(mode_node)
+    text = 'color/1' if node.empty() else node.string()
+    fs.release()
+    return DecodeMode.parse(text)
@@ -0,0 +1,283 @@
+import cv2 as cv
+import numpy as np
+
+# OpenCV votes for the first (lowest) class label when the decision value of
+# a two class SVM is positive.
+labels = (-1, 1)
+
+
+def rbf_kernel(x, y, gamma):
+    distances = (np.einsum('ij,ij->i', x, x)[:, None] +
+                 np.einsum('ij,ij->i', y, y)[None, :] - 2 * x @ y.T)
+    np.maximum(distances, 0, out=distances)
+    return np.exp(-gamma * distances, out=distances)
+
+
+def rbf_expansion(svm):
+    assert (svm.getKernelType() == cv.ml.SVM_RBF)
+    support_vectors = svm.getSupportVectors()
+    rho, alpha, sv_index = svm.getDecisionFunction(0)
+    return (np.float32(support_vectors[sv_index.ravel()]),
+            np.float32(alpha.ravel()), rho, svm.getGamma())
+
+
+def landmarks(points, n, seed=0):
+    cv.setRNGSeed(seed)
+    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 20, 1e-3)
+    _, _, centers = cv.kmeans(np.float32(points), n, None, criteria, 1,
+                              cv.KMEANS_PP_CENTERS)
+    return centers
+
+
+def decision_labels(decision):
+    return np.float32(np.where(decision > 0, labels[0], labels[1])).reshape(
+        -1, 1)
+
+
+def positive_margin(model, samples):
+    # Decision values of cv.ml.SVM or KernelExpansion models, positive when
+    # the predicted label is 1
+    decision = model.predict(samples, flags=cv.ml.STAT_MODEL_RAW_OUTPUT)[1]
+    return -decision.ravel() if labels[0] == -1 else decision.ravel()
+
+
+class KernelExpansion:
+    # Decision function sum(coefficients * K(vectors, x)) - rho, with the same
+    # predict() interface as cv.ml.SVM.
+
+    kind = 'expansion'
+
+    def __init__(self, vectors, coefficients, rho, gamma):
+        # Vectors may be stored as float16, they are computed as float32
+        self.vectors = vectors
+        self.vectors32 = np.float32(vectors)
+        self.coefficients = np.float32(coefficients)
+        self.rho = rho
+        self.gamma = gamma
+
+    def decision_function(self, samples):
+        samples = np.float32(samples).reshape(len(samples), -1)
+        kernel = rbf_kernel(samples, self.vectors32, self.gamma)
+        return kernel @ self.coefficients - self.rho
+
+    def predict(self, samples, flags=0):
+        decision = self.decision_function(samples)
+        if flags & cv.ml.STAT_MODEL_RAW_OUTPUT:
+            return 0.0, np.float32(decision).reshape(-1, 1)
+        return 0.0, decision_labels(decision)
+
+    def save(self, path):
+        np.savez(path,
+                 kind=self.kind,
+                 vectors=self.vectors,
+                 coefficients=self.coefficients,
+                 rho=self.rho,
+                 gamma=self.gamma)
+
+
+class NystroemSVM(KernelExpansion):
+    # Nyström feature map phi(x) = K(x, landmarks) @ P, with P P' the
+    # pseudo-inverse of K(landmarks, landmarks). The linear decision function
+    # on phi, w = P' K(landmarks, sv) alpha, is folded into the landmark
+    # coefficients P w, so prediction costs n_components kernel evaluations.
+
+    kind = 'nystroem'
+
+    @classmethod
+    def fit(cls, svm, n_components=256, seed=0):
+        support_vectors, alpha, rho, gamma = rbf_expansion(svm)
+        if n_components >= len(support_vectors):
+            return cls(support_vectors, alpha, rho, gamma)
+
+        centers = landmarks(support_vectors, n_components, seed)
+        eigenvalues, eigenvectors = np.linalg.eigh(
+            rbf_kernel(centers, centers, gamma).astype(np.float64))
+        keep = eigenvalues > eigenvalues.max() * 1e-8
+        projection = eigenvectors[:, keep] / np.sqrt(eigenvalues[keep])
+        weights = projection.T @ (rbf_kernel(centers, support_vectors, gamma)
+                                  @ alpha)
+        return cls(centers, np.float32(projection @ weights), rho, gamma)
+
+
+class ReducedSVM(KernelExpansion):
+    # Reduced set of support vectors: k-means centers of the support vectors,
+    # with coefficients fitted by ridge regression to reproduce the decision
+    # values of the full model on the support vectors and on `samples`.
+
+    kind = 'reduced'
+
+    @classmethod
+    def fit(cls,
+            svm,
+            samples,
+            n_vectors,
+            float16=False,
+            max_samples=5000,
+            regularization=1e-6,
+            seed=0):
+        support_vectors, alpha, rho, gamma = rbf_expansion(svm)
+        dtype = np.float16 if float16 else np.float32
+        if n_vectors >= len(support_vectors):
+            return cls(support_vectors.astype(dtype), alpha, rho, gamma)
+
+        samples = np.float32(samples).reshape(len(samples), -1)
+        if len(samples) > max_samples:
+            rng = np.random.default_rng(seed)
+            samples = samples[rng.choice(len(samples), max_samples, False)]
+        points = np.concatenate((support_vectors, samples))
+        target = rbf_kernel(points, support_vectors, gamma) @ alpha
+
+        # Coefficients are fitted to the vectors as they will be stored
+        vectors = landmarks(support_vectors, n_vectors, seed).astype(dtype)
+        kernel = rbf_kernel(points, np.float32(vectors), gamma)
+        gram = kernel.T @ kernel
+        gram[np.diag_indices_from(gram)] += regularization * np.trace(
+            gram) / len(gram)
+        coefficients = np.linalg.solve(gram, kernel.T @ target)
+        return cls(vectors, coefficients, rho, gamma)
+
+
+def accuracy(model, samples, labels):
+    result = model.predict(samples)[1]
+    return np.count_nonzero(result == labels) * 100.0 / result.size
+
+
+def reduce_svm(svm,
+               samples,
+               labels,
+               n_vectors=None,
+               max_accuracy_loss=1.0,
+               float16=False):
+    # Fits `n_vectors` vectors, or halves the support vectors while the
+    # accuracy on `samples` stays within `max_accuracy_loss` points.
+    samples = np.asarray(samples, np.float32).reshape(len(samples), -1)
+    labels = np.float32(labels).reshape(-1, 1)
+    n_support_vectors = len(rbf_expansion(svm)[0])
+    if n_vectors is not None:
+        return ReducedSVM.fit(svm, samples, n_vectors, float16)
+
+    minimum = accuracy(svm, samples, labels) - max_accuracy_loss
+    best = ReducedSVM.fit(svm, samples, n_support_vectors, float16)
+    size = n_support_vectors // 2
+    while size >= 1:
+        model = ReducedSVM.fit(svm, samples, size, float16)
+        if accuracy(model, samples, labels) < minimum:
+            break
+        best = model
+        size //= 2
+    return best
+
+
+class LinearPrefilter:
+    # Linear SVM margin weights' x + bias, positive for label 1. Samples with
+    # a margin below `low` are rejected and above `high` accepted, the
+    # others are uncertain.
+
+    kind = 'prefilter'
+
+    def __init__(self, weights, bias, low=-np.inf, high=np.inf):
+        self.weights = np.float32(weights).ravel()
+        self.bias = float(bias)
+        self.low = float(low)
+        self.high = float(high)
+
+    @classmethod
+    def fit(cls, samples, sample_labels, C=1.0):
+        svm = cv.ml.SVM_create()
+        svm.setType(cv.ml.SVM_C_SVC)
+        svm.setKernel(cv.ml.SVM_LINEAR)
+        svm.setC(C)
+        svm.train(np.asarray(samples, np.float32), cv.ml.ROW_SAMPLE,
+                  np.int32(sample_labels).reshape(-1, 1))
+        # The support vectors of a linear SVM are compressed to the weights
+        rho, alpha, sv_index = svm.getDecisionFunction(0)
+        weights = alpha.ravel() @ svm.getSupportVectors()[sv_index.ravel()]
+        if labels[0] == -1:
+            return cls(-weights, rho)
+        return cls(weights, -rho)
+
+    def margin(self, samples):
+        samples = np.asarray(samples, np.float32).reshape(len(samples), -1)
+        return samples @ self.weights + self.bias
+
+    def calibrate(self, samples, labels, recall=0.99):
+        # Thresholds rejecting at most 1 - `recall` of the positive samples
+        # and accepting at most 1 - `recall` of the negative ones
+        margins = self.margin(samples)
+        labels = np.ravel(labels)
+        positives = np.sort(margins[labels == 1])
+        negatives = np.sort(margins[labels != 1])[::-1]
+        self.low = -np.inf
+        self.high = np.inf
+        if len(positives):
+            self.low = float(positives[int(len(positives) * (1 - recall))])
+        if len(negatives):
+            self.high = float(negatives[int(len(negatives) * (1 - recall))])
+        self.high = max(self.high, self.low)
+
+    def save(self, path):
+        np.savez(path,
+                 kind=self.kind,
+                 weights=self.weights,
+                 bias=self.bias,
+                 low=self.low,
+                 high=self.high)
+
+
+class CascadeModel:
+    # Samples outside the uncertain band of the prefilter are decided by
+    # it, the others by `model`. Same predict() interface as cv.ml.SVM; raw
+    # outputs of the two stages have different scales.
+
+    def __init__(self, prefilter, model):
+        self.prefilter = prefilter
+        self.model = model
+        self.samples = 0
+        self.forwarded = 0
+
+    @property
+    def forwarded_fraction(self):
+        return self.forwarded / max(1, self.samples)
+
+    def predict(self, samples, flags=0):
+        samples = np.asarray(samples, np.float32).reshape(len(samples), -1)
+        low = self.prefilter.low
+        high = self.prefilter.high
+        margins = self.prefilter.margin(samples)
+        uncertain = (margins >= low) & (margins <= high)
+        if flags & cv.ml.STAT_MODEL_RAW_OUTPUT:
+            # Margins from the threshold that decided the sample
+            margins = np.where(margins > high, margins - high, margins - low)
+            output = np.float32(-margins if labels[0] == -1 else margins)
+        else:
+            output = np.float32(np.where(margins > high, 1, -1))
+        if uncertain.any():
+            output[uncertain] = self.model.predict(samples[uncertain],
+                                                   flags=flags)[1].ravel()
+        self.samples += len(samples)
+        self.forwarded += int(np.count_nonzero(uncertain))
+        return 0.0, output.reshape(-1, 1)
+
+
+def load_prefilter(path):
+    model = np.load(path)
+    return LinearPrefilter(model['weights'], float(model['bias']),
+                           float(model['low']), float(model['high']))
+
+
+def input_len(model):
+    # Number of features the model was trained on
+    if isinstance(model, KernelExpansion):
+        return model.vectors.shape[1]
+    return model.getVarCount()
+
+
+def load_model(path):
+    if not str(path).endswith('.npz'):
+        return cv.ml.SVM.load(str(path))
+
+    model = np.load(path)
+    kinds = {c.kind: c for c in (KernelExpansion, NystroemSVM, ReducedSVM)}
+    return kinds[str(model['kind'])](model['vectors'], model['coefficients'],
+                                     float(model['rho']),
+                                     float(model['gamma']))
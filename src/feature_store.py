@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import pathlib
+
+import numpy as np
+
+hog_attributes = ('winSize', 'blockSize', 'blockStride', 'cellSize', 'nbins',
+                  'derivAperture', 'winSigma', 'histogramNormType',
+                  'L2HysThreshold', 'gammaCorrection', 'nlevels',
+                  'signedGradient')
+
+
+def file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hog_description(hog):
+    description = {}
+    for name in hog_attributes:
+        value = getattr(hog, name)
+        description[name] = list(value) if isinstance(value,
+                                                      tuple) else value
+    return description
+
+
+def store_description(hog, extra=None):
+    description = hog_description(hog)
+    description.update(extra or {})
+    return description
+
+
+def description_key(description):
+    description = json.dumps(description, sort_keys=True)
+    return hashlib.sha1(description.encode()).hexdigest()[:16]
+
+
+class FeatureStore:
+    # Rows of a float32 matrix on `features.f32`, one per image content
+    # digest listed on `index.txt`. Images without features (e.g. too dark)
+    # are kept on the index with row -1. `extra` settings that change the
+    # features, like the preprocessing, are part of the store key.
+
+    def __init__(self, root, hog, extra=None):
+        description = store_description(hog, extra)
+        self.feature_len = hog.getDescriptorSize()
+        self.directory = pathlib.Path(root) / description_key(description)
+        self.data_path = self.directory / 'features.f32'
+        self.index_path = self.directory / 'index.txt'
+        self.rows = {}
+        self.count = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta_path = self.directory / 'meta.json'
+        if not meta_path.is_file():
+            with open(meta_path, 'w') as f:
+                json.dump(description, f, indent=2)
+        self.load_index()
+
+    def load_index(self):
+        row_bytes = self.feature_len * 4
+        data_rows = 0
+        if self.data_path.is_file():
+            data_rows = os.path.getsize(self.data_path) // row_bytes
+        if self.index_path.is_file():
+            with open(self.index_path) as f:
+                for line in f:
+                    digest, row = line.split()
+                    row = int(row)
+                    if row >= data_rows:
+                        # Index entry written without its data
+                        break
+                    self.rows[digest] = row
+                    self.count = max(self.count, row + 1)
+
+    def __contains__(self, digest):
+        return digest in self.rows
+
+    def __len__(self):
+        return self.count
+
+    def row(self, digest):
+        return self.rows[digest]
+
+    def append(self, digests, features):
+        rows = []
+        with open(self.data_path, 'r+b' if self.data_path.is_file() else
+                  'wb') as data:
+            data.seek(self.count * self.feature_len * 4)
+            for f in features:
+                if f is None:
+                    rows.append(-1)
+                    continue
+                data.write(np.float32(f).reshape(-1).tobytes())
+                rows.append(self.count)
+                self.count += 1
+            data.truncate()
+        with open(self.index_path, 'a') as index:
+            for digest, row in zip(digests, rows):
+                index.write(f'{digest} {row}\n')
+                self.rows[digest] = row
+        return rows
+
+    def matrix(self):
+        if self.count == 0:
+            return np.empty((0, self.feature_len), np.float32)
+        return np.memmap(self.data_path,
+                         dtype=np.float32,
+                         mode='r',
+                         shape=(self.count, self.feature_len))
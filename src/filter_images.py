@@ -1,12 +1,28 @@
 import pathlib
 import os
 import math
+from functools import partial
+from multiprocessing import Pool
 
 from PIL import Image
-import imagehash
 import cv2 as cv
 import numpy as np
 
+import blur
+import instrument
+from hash_index import HammingIndex, image_hash
+from metrics_index import MetricsIndex
+
+hash_kind = 'ahash'  # 'ahash', 'dhash' or 'phash'
+max_hash_distance = 0
+contrast_threshold = 1
+blur_threshold = None  # None to keep blurred images
+blur_backend = 'fft'  # 'fft', 'laplacian' or 'tenengrad'
+blur_reduction = 1  # 1, 2, 4 or 8
+remove_outliers = False
+n_workers = os.cpu_count()
+metrics_path = 'images/metrics.sqlite'
+
 
 def get_images(directory):
     img_files = pathlib.Path(directory).iterdir()
@@ -18,51 +34,47 @@ def get_images(directory):
     return imgs
 
 
-def flip(h, i):
-    bits = h.hash.flatten().copy()
-    bits[i] = not bits[i]
-    return imagehash.ImageHash(bits)
+def find_duplicates(hashes, dups_dir, max_distance=0, metrics_index=None):
+    hash_index = HammingIndex(max_distance)
+    for img_path, h in hashes:
+        matches = hash_index.query(h)
+        if matches:
+            distance, similar_path = matches[0]
+            if distance == 0:
+                print(f'{similar_path} and {img_path} are similar (same hash)')
+            else:
+                print(f'{similar_path} and {img_path} are similar ' +
+                      f'(Hamming distance {distance})')
+            move(img_path, dups_dir, metrics_index)
+        else:
+            hash_index.add(h, img_path)
 
 
-def hash_compare(directory, dups_dir, flip_hash=False):
-    hash_bucket = {}
-    for img_path in get_images(directory):
-        h = imagehash.average_hash(Image.open(img_path))
-        if h in hash_bucket:
-            print(f'{hash_bucket[h]} and {img_path} are similar (same hash)')
-            os.rename(img_path,
-                      os.path.join(dups_dir, os.path.basename(img_path)))
-        else:
-            hash_bucket[h] = img_path
-
-    if flip_hash:
-        for h in list(hash_bucket):
-            for i in range(len(h)):
-                h2 = flip(h, i)
-                if h2 in hash_bucket and os.path.exists(hash_bucket[h2]):
-                    print(
-                        f'{hash_bucket[h]} and {hash_bucket[h2]} are similar' +
-                        ' (Hamming distance 1)')
-                    os.rename(
-                        hash_bucket[h2],
-                        os.path.join(dups_dir,
-                                     os.path.basename(hash_bucket[h2])))
-            hash_bucket.pop(h)
-
-
-def filter_blurred(directory, blurred_dir, threshold=5, size=60):
+def hash_compare(directory,
+                 dups_dir,
+                 max_distance=0,
+                 hash_kind='ahash',
+                 index=None):
+    imgs = get_images(directory)
+    if index is None:
+        hashes = ((img_path, image_hash(Image.open(img_path), hash_kind))
+                  for img_path in imgs)
+    else:
+        imgs_metrics = compute_metrics(imgs, hash_kind, index=index)
+        hashes = ((img_path, metrics['hash'])
+                  for img_path, metrics in zip(imgs, imgs_metrics)
+                  if metrics is not None)
+    find_duplicates(hashes, dups_dir, max_distance, index)
+
+
+def filter_blurred(directory,
+                   blurred_dir,
+                   threshold=5,
+                   size=60,
+                   backend='fft',
+                   reduction=1):
     for img_path in get_images(directory):
-        im = cv.imread(img_path, 0)
-        h, w = im.shape
-        centerY, centerX = h // 2, w // 2
-        fft = np.fft.fft2(im)
-        fft_shift = np.fft.fftshift(fft)
-        fft_shift[centerY - size:centerY + size,
-                  centerX - size:centerX + size] = 0
-        fft_shift = np.fft.ifftshift(fft_shift)
-        recon = np.fft.ifft2(fft_shift)
-        magnitude = 20 * np.log(np.abs(recon))
-        mean = np.mean(magnitude)
+        mean = blur.score_file(img_path, backend, reduction, size)
 
         if mean <= threshold:
             print(f'{img_path} is blurry ({mean:.02f})')
@@ -77,27 +89,35 @@ def entropy(im):
     return entropy
 
 
-def filter_outliers(directory, outliers_dir):
+def outlier_range(metrics):
+    lower_quantile = np.percentile(metrics, 25)
+    upper_quantile = np.percentile(metrics, 75)
+    iqr_constant = 1.5
+    iqr = (upper_quantile - lower_quantile) * iqr_constant
+    return (lower_quantile - iqr, upper_quantile + iqr)
+
+
+def filter_outliers(directory, outliers_dir, index=None):
     imgs = get_images(directory)
     imgs_metric = []
-    for img_path in imgs:
-        im = cv.imread(img_path, 0)
-        imgs_metric.append(entropy(im))
+    if index is None:
+        for img_path in imgs:
+            im = cv.imread(img_path, 0)
+            imgs_metric.append(entropy(im))
+    else:
+        imgs_metrics = compute_metrics(imgs, index=index)
+        imgs = [p for p, m in zip(imgs, imgs_metrics) if m is not None]
+        imgs_metric = [m['entropy'] for m in imgs_metrics if m is not None]
 
     outliers = []
-    lower_quantile = np.percentile(imgs_metric, 25)
-    upper_quantile = np.percentile(imgs_metric, 75)
-    iqr_constant = 1.5
-    iqr = (upper_quantile - lower_quantile) * iqr_constant
-    quantile_range = (lower_quantile - iqr, upper_quantile + iqr)
+    quantile_range = outlier_range(imgs_metric)
     for img_path, metric in zip(imgs, imgs_metric):
         if metric < quantile_range[0] or metric > quantile_range[1]:
             outliers.append((img_path, metric))
 
     for outlier, metric in outliers:
         print(f'{outlier} is lighter or darker than others ({metric:.02f})')
-        os.rename(outlier, os.path.join(outliers_dir,
-                                        os.path.basename(outlier)))
+        move(outlier, outliers_dir, index)
 
 
 def filter_low_contrast(directory, low_contrast_dir, threshold=2):
@@ -111,20 +131,155 @@ def filter_low_contrast(directory, low_contrast_dir, threshold=2):
                 os.path.join(low_contrast_dir, os.path.basename(img_path)))
 
 
-def filter_directory(directory):
-    dups_dir = os.path.join(directory, 'copies')
-    if not os.path.exists(dups_dir):
-        os.makedirs(dups_dir)
+def image_metrics(img_path,
+                  hash_kind='ahash',
+                  blur_backend=None,
+                  blur_reduction=1,
+                  blur_size=60):
+    im = instrument.imread(img_path, cv.IMREAD_GRAYSCALE)
+    if im is None:
+        return None
+    blur_score = None
+    if blur_backend is not None:
+        with instrument.span('blur'):
+            blur_score = blur.blur_score(blur.reduce(im, blur_reduction),
+                                         blur_backend, blur_reduction,
+                                         blur_size)
+    with instrument.span('entropy'):
+        im_entropy = entropy(im)
+    with instrument.span('hash'):
+        h = image_hash(Image.fromarray(im), hash_kind)
+    return {
+        'entropy': im_entropy,
+        'blur': blur_score,
+        'hash': h,
+        'brightness': float(np.mean(im)),
+    }
+
+
+def compute_metrics(imgs,
+                    hash_kind='ahash',
+                    blur_backend=None,
+                    blur_reduction=1,
+                    n_workers=1,
+                    index=None):
+    # Metrics stored on `index` are not computed again
+    blur_kind = None
+    if blur_backend is not None:
+        blur_kind = f'{blur_backend}/{blur_reduction}'
+    imgs_metrics = [None] * len(imgs)
+    if index is not None:
+        imgs_metrics = [index.get(p, hash_kind, blur_kind) for p in imgs]
+    missing = [i for i, m in enumerate(imgs_metrics) if m is None]
+
+    metrics = partial(image_metrics,
+                      hash_kind=hash_kind,
+                      blur_backend=blur_backend,
+                      blur_reduction=blur_reduction)
+    missing_imgs = [imgs[i] for i in missing]
+    instrument.count('metrics_cached', len(imgs) - len(missing))
+    instrument.count('metrics_computed', len(missing))
+    with instrument.span('compute_metrics'):
+        if n_workers <= 1 or len(missing) <= 1:
+            computed = list(map(metrics, missing_imgs))
+        else:
+            with Pool(n_workers, cv.setNumThreads, (1, )) as pool:
+                chunksize = max(1, min(64, len(missing) // (n_workers * 4)))
+                computed = list(
+                    instrument.results(
+                        pool.imap(partial(instrument.call, metrics),
+                                  missing_imgs, chunksize)))
+
+    for i, m in zip(missing, computed):
+        imgs_metrics[i] = m
+    if index is not None:
+        index.put(((p, m) for p, m in zip(missing_imgs, computed)
+                   if m is not None), hash_kind, blur_kind)
+    return imgs_metrics
+
+
+def make_dir(directory, name):
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def move(img_path, directory, index=None):
+    new_path = os.path.join(directory, os.path.basename(img_path))
+    instrument.count(f'moved_to_{os.path.basename(directory)}')
+    os.rename(img_path, new_path)
+    if index is not None:
+        index.rename(img_path, new_path)
+
+
+def filter_directory(directory,
+                     contrast_threshold=1,
+                     blur_threshold=None,
+                     remove_outliers=False,
+                     max_hash_distance=0,
+                     hash_kind='ahash',
+                     n_workers=1,
+                     blur_backend='fft',
+                     blur_reduction=1,
+                     index=None):
+    # Decodes each image once, then applies the low contrast, blurred,
+    # outliers and duplicates filters in this order.
+    dups_dir = make_dir(directory, 'copies')
+    low_contrast_dir = make_dir(directory, 'low_contrast')
+
+    imgs = get_images(directory)
+    imgs_metrics = compute_metrics(
+        imgs, hash_kind, None if blur_threshold is None else blur_backend,
+        blur_reduction, n_workers, index)
+    remaining = []
+    for img_path, metrics in zip(imgs, imgs_metrics):
+        if metrics is None:
+            print(f'{img_path} could not be opened')
+        elif metrics['entropy'] < contrast_threshold:
+            print(f'{img_path} has low contrast ({metrics["entropy"]:.02f})')
+            move(img_path, low_contrast_dir, index)
+        else:
+            remaining.append((img_path, metrics))
+
+    if blur_threshold is not None:
+        blurred_dir = make_dir(directory, 'blurred')
+        images = remaining
+        remaining = []
+        for img_path, metrics in images:
+            if metrics['blur'] <= blur_threshold:
+                print(f'{img_path} is blurry ({metrics["blur"]:.02f})')
+                move(img_path, blurred_dir, index)
+            else:
+                remaining.append((img_path, metrics))
 
-    low_contrast_dir = os.path.join(directory, 'low_contrast')
-    if not os.path.exists(low_contrast_dir):
-        os.makedirs(low_contrast_dir)
+    if remove_outliers and remaining:
+        outliers_dir = make_dir(directory, 'outliers')
+        quantile_range = outlier_range([m['entropy'] for _, m in remaining])
+        images = remaining
+        remaining = []
+        for img_path, metrics in images:
+            metric = metrics['entropy']
+            if metric < quantile_range[0] or metric > quantile_range[1]:
+                print(f'{img_path} is lighter or darker than others ' +
+                      f'({metric:.02f})')
+                move(img_path, outliers_dir, index)
+            else:
+                remaining.append((img_path, metrics))
 
-    filter_low_contrast(directory, low_contrast_dir, threshold=1)
-    hash_compare(directory, dups_dir)
+    with instrument.span('find_duplicates'):
+        find_duplicates(((p, m['hash']) for p, m in remaining), dups_dir,
+                        max_hash_distance, index)
+    if index is not None:
+        with instrument.span('index_commit'):
+            index.commit()
 
 
 if __name__ == '__main__':
-    filter_directory('images/undefined')
-    filter_directory('images/positives')
-    filter_directory('images/negatives')
+    index = MetricsIndex(metrics_path)
+    for directory in ('images/undefined', 'images/positives',
+                      'images/negatives'):
+        filter_directory(directory, contrast_threshold, blur_threshold,
+                         remove_outliers, max_hash_distance, hash_kind,
+                         n_workers, blur_backend, blur_reduction, index)
+    index.close()
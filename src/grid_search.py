@@ -0,0 +1,191 @@
+import csv
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+# (min, max, logarithmic step), the defaults of cv.ml.SVM.trainAuto
+c_grid = (0.1, 500, 5)
+gamma_grid = (1e-5, 0.6, 15)
+k_fold = 10
+n_refine = 2
+refine_points = 5
+# Cells whose first fold is this many accuracy points below the best cell
+# are not evaluated on the remaining folds.
+abandon_margin = 10.0
+
+_data = None
+_labels = None
+_folds = None
+
+
+def grid_values(min_val, max_val, step):
+    values = []
+    value = min_val
+    while value < max_val:
+        values.append(value)
+        value *= step
+    return values
+
+
+def refine_values(center, step, points):
+    # `points` values spaced logarithmically between the neighbours of
+    # `center` in a grid with the given step
+    exponents = np.linspace(-1, 1, points)
+    return [center * step**e for e in exponents], step**(2 / (points - 1))
+
+
+def fold_indices(labels, k, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = np.ravel(labels)
+    folds = np.empty(len(labels), np.int32)
+    for label in np.unique(labels):
+        index = np.flatnonzero(labels == label)
+        rng.shuffle(index)
+        folds[index] = np.arange(len(index)) % k
+    return folds
+
+
+def init_worker(data_path, labels, folds):
+    global _data, _labels, _folds
+    cv.setNumThreads(1)
+    _data = np.load(data_path, mmap_mode='r')
+    _labels = labels
+    _folds = folds
+
+
+def evaluate(job):
+    C, gamma, fold = job
+    train_mask = _folds != fold
+    start = time.perf_counter()
+    train_labels = _labels[train_mask]
+    test_labels = _labels[~train_mask]
+    if len(np.unique(train_labels)) < 2:
+        # Every sample of a class is on this fold, the SVM can not be
+        # trained and would only predict the other class
+        result = np.full_like(test_labels, train_labels[0, 0])
+    else:
+        svm = cv.ml.SVM_create()
+        svm.setType(cv.ml.SVM_C_SVC)
+        svm.setKernel(cv.ml.SVM_RBF)
+        svm.setC(C)
+        svm.setGamma(gamma)
+        svm.train(np.ascontiguousarray(_data[train_mask]), cv.ml.ROW_SAMPLE,
+                  train_labels)
+        result = svm.predict(np.ascontiguousarray(_data[~train_mask]))[1]
+    correct = np.count_nonzero(result == test_labels)
+    accuracy = correct * 100.0 / result.size
+    return accuracy, time.perf_counter() - start
+
+
+class Cell:
+
+    def __init__(self, C, gamma, stage):
+        self.C = C
+        self.gamma = gamma
+        self.stage = stage
+        self.accuracies = []
+        self.time = 0.0
+        self.abandoned = False
+
+    @property
+    def accuracy(self):
+        return float(np.mean(self.accuracies))
+
+    def add(self, result):
+        accuracy, elapsed = result
+        self.accuracies.append(accuracy)
+        self.time += elapsed
+
+
+def run_stage(pool, cells, k, n_workers, best):
+    jobs = [(cell.C, cell.gamma, 0) for cell in cells]
+    for cell, result in zip(cells, pool.map(evaluate, jobs)):
+        cell.add(result)
+
+    best = max([best] + [cell.accuracy for cell in cells])
+    for cell in cells:
+        cell.abandoned = cell.accuracy < best - abandon_margin
+
+    survivors = [cell for cell in cells if not cell.abandoned]
+    jobs = [(cell.C, cell.gamma, fold) for cell in survivors
+            for fold in range(1, k)]
+    chunksize = max(1, len(jobs) // (n_workers * 4))
+    results = pool.map(evaluate, jobs, chunksize=chunksize)
+    for i, result in enumerate(results):
+        survivors[i // (k - 1)].add(result)
+
+
+def write_report(cells, report_path):
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ['stage', 'C', 'gamma', 'folds', 'accuracy', 'time', 'abandoned'])
+        for cell in sorted(cells, key=lambda c: -c.accuracy):
+            writer.writerow([
+                cell.stage, f'{cell.C:.6g}', f'{cell.gamma:.6g}',
+                len(cell.accuracies), f'{cell.accuracy:.2f}',
+                f'{cell.time:.3f}', cell.abandoned
+            ])
+
+
+def search(data,
+           labels,
+           n_workers=1,
+           k=k_fold,
+           refine=n_refine,
+           report_path='models/svm_last_search.csv'):
+    labels = np.int32(labels).reshape(-1, 1)
+    # Every fold needs a sample to test: at most as many folds as samples of
+    # the largest class
+    _, class_counts = np.unique(labels, return_counts=True)
+    k = min(k, int(class_counts.max(initial=0)))
+    if k < 2 or len(class_counts) < 2:
+        print('Too few samples to search SVM parameters, using ' +
+              f'C={c_grid[0]:.6g} gamma={gamma_grid[0]:.6g}')
+        return float(c_grid[0]), float(gamma_grid[0])
+    folds = fold_indices(labels, k)
+    c_step = c_grid[2]
+    gamma_step = gamma_grid[2]
+    candidates = [(C, gamma) for C in grid_values(*c_grid)
+                  for gamma in grid_values(*gamma_grid)]
+    cells = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = os.path.join(tmp, 'data.npy')
+        np.save(data_path, np.asarray(data, np.float32))
+        with ProcessPoolExecutor(n_workers, initializer=init_worker,
+                                 initargs=(data_path, labels,
+                                           folds)) as pool:
+            for stage in range(refine + 1):
+                new_cells = [
+                    Cell(C, gamma, stage) for C, gamma in candidates
+                    if (C, gamma) not in cells
+                ]
+                best = max([
+                    c.accuracy for c in cells.values() if not c.abandoned
+                ] or [0.0])
+                run_stage(pool, new_cells, k, n_workers, best)
+                cells.update(((c.C, c.gamma), c) for c in new_cells)
+
+                # Ties are kept on the first cell evaluated, as trainAuto
+                best_cell = max(
+                    (c for c in cells.values() if not c.abandoned),
+                    key=lambda c: c.accuracy)
+                print(f'Stage {stage}: {len(new_cells)} cells, best ' +
+                      f'C={best_cell.C:.6g} gamma={best_cell.gamma:.6g} ' +
+                      f'({best_cell.accuracy:.2f}%)')
+
+                c_values, c_step = refine_values(best_cell.C, c_step,
+                                                 refine_points)
+                gamma_values, gamma_step = refine_values(
+                    best_cell.gamma, gamma_step, refine_points)
+                candidates = [(C, gamma) for C in c_values
+                              for gamma in gamma_values]
+
+    if report_path is not None:
+        write_report(cells.values(), report_path)
+    return float(best_cell.C), float(best_cell.gamma)
@@ -0,0 +1,77 @@
+import itertools
+
+import imagehash
+import numpy as np
+
+hash_functions = {
+    'ahash': imagehash.average_hash,
+    'dhash': imagehash.dhash,
+    'phash': imagehash.phash,
+}
+
+
+def image_hash(image, kind='ahash'):
+    return pack_hash(hash_functions[kind](image))
+
+
+def pack_hash(h):
+    return int.from_bytes(np.packbits(h.hash.flatten()).tobytes(), 'big')
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class HammingIndex:
+    # Multi-index hashing: hashes are split in `n_chunks` chunks with a
+    # table each. Two hashes within `max_distance` bits have at least one
+    # chunk within max_distance // n_chunks bits, so a query only looks up
+    # the chunks' neighbours within that radius. By default chunks are
+    # chosen so that radius is at most 1.
+
+    def __init__(self, max_distance=0, n_chunks=None, bits=64):
+        if n_chunks is None:
+            n_chunks = min(max_distance // 2 + 1, bits)
+        self.max_distance = max_distance
+        self.n_chunks = n_chunks
+        self.chunk_bits = -(-bits // n_chunks)
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        self.tables = [{} for _ in range(n_chunks)]
+        self.hashes = []
+        self.values = []
+
+        radius = min(max_distance // n_chunks, self.chunk_bits)
+        self.neighbours = [0]
+        for distance in range(1, radius + 1):
+            for positions in itertools.combinations(range(self.chunk_bits),
+                                                    distance):
+                self.neighbours.append(sum(1 << p for p in positions))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def chunks(self, h):
+        for i in range(self.n_chunks):
+            yield (h >> (i * self.chunk_bits)) & self.chunk_mask
+
+    def add(self, h, value):
+        item = len(self.hashes)
+        self.hashes.append(h)
+        self.values.append(value)
+        for table, chunk in zip(self.tables, self.chunks(h)):
+            table.setdefault(chunk, []).append(item)
+
+    def query(self, h):
+        # (distance, value) of every hash within max_distance of h
+        candidates = set()
+        for table, chunk in zip(self.tables, self.chunks(h)):
+            for neighbour in self.neighbours:
+                candidates.update(table.get(chunk ^ neighbour, ()))
+
+        matches = []
+        for item in candidates:
+            distance = hamming_distance(h, self.hashes[item])
+            if distance <= self.max_distance:
+                matches.append((distance, self.values[item]))
+        matches.sort()
+        return matches
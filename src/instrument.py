@@ -0,0 +1,222 @@
+import atexit
+import contextlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+
+# Set by the environment, e.g.
+# INSTRUMENT_SUMMARY=summary.json python src/classifier.py < paths.txt
+summary_path = os.environ.get('INSTRUMENT_SUMMARY')
+trace_path = os.environ.get('INSTRUMENT_TRACE')  # Chrome trace format
+profile = os.environ.get('INSTRUMENT_PROFILE')  # 'cprofile' or 'tracemalloc'
+profile_path = os.environ.get('INSTRUMENT_PROFILE_PATH', 'instrument.prof')
+max_trace_events = 1000000
+enabled = bool(summary_path or trace_path or profile)
+
+_lock = threading.Lock()
+_null_span = contextlib.nullcontext()
+_durations = {}
+_counters = {}
+_events = []
+_pid = os.getpid()
+_start = time.perf_counter_ns()
+_profiler = None
+
+
+class Span:
+    # Times its block and records it under `name`
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        with _lock:
+            _durations.setdefault(self.name, []).append(end - self.start)
+            if trace_path and len(_events) < max_trace_events:
+                _events.append((self.name, self.start, end, os.getpid(),
+                                threading.get_ident()))
+        return False
+
+
+def span(name):
+    # Does nothing when instrumentation is disabled
+    return Span(name) if enabled else _null_span
+
+
+def count(name, n=1):
+    if enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def imread(path, flags=cv.IMREAD_COLOR):
+    # cv.imread, timing the disk read apart from the decode when enabled
+    if not enabled:
+        return cv.imread(path, flags)
+    with span('read'):
+        try:
+            data = np.fromfile(path, np.uint8)
+        except OSError:
+            return None
+    count('read_bytes', data.size)
+    if data.size == 0:
+        return None
+    with span('decode'):
+        return cv.imdecode(data, flags)
+
+
+def collect():
+    # Spans and counters recorded since the last call, which are cleared.
+    # Pool workers return them with their results (see call).
+    global _durations, _counters, _events
+    if not enabled:
+        return None
+    with _lock:
+        recorded = (_durations, _counters, _events)
+        _durations = {}
+        _counters = {}
+        _events = []
+    return recorded
+
+
+def merge(recorded):
+    # Adds the spans and counters collected on a pool worker
+    if recorded is None:
+        return
+    durations, counters, events = recorded
+    with _lock:
+        for name, d in durations.items():
+            _durations.setdefault(name, []).extend(d)
+        for name, n in counters.items():
+            _counters[name] = _counters.get(name, 0) + n
+        _events.extend(events[:max(0, max_trace_events - len(_events))])
+
+
+def call(function, *args):
+    # Runs `function` on a pool worker and returns its result with the
+    # spans recorded by it, e.g. pool.imap(partial(call, function), items)
+    result = function(*args)
+    return result, collect()
+
+
+def results(calls):
+    # Results of `call`, merging their spans on the main process
+    for result, recorded in calls:
+        merge(recorded)
+        yield result
+
+
+def histogram(durations):
+    # Number of durations on each power of two of microseconds
+    buckets = {}
+    for d in durations:
+        bucket = 1 << max(0, math.ceil(math.log2(max(1, d / 1000))))
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+    return {f'<={b}us': buckets[b] for b in sorted(buckets)}
+
+
+def summary():
+    spans = {}
+    with _lock:
+        durations = {name: list(d) for name, d in _durations.items()}
+        counters = dict(_counters)
+    for name, d in sorted(durations.items()):
+        ms = np.array(d) / 1e6
+        spans[name] = {
+            'count': len(d),
+            'total_ms': float(ms.sum()),
+            'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(ms.max()),
+            'histogram': histogram(d),
+        }
+    content = {
+        'wall_ms': (time.perf_counter_ns() - _start) / 1e6,
+        'spans': spans,
+        'counters': counters,
+    }
+    if profile == 'tracemalloc':
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:20]
+        content['memory'] = {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'top': [{
+                'location': str(stat.traceback),
+                'bytes': stat.size,
+                'count': stat.count
+            } for stat in top],
+        }
+    return content
+
+
+def chrome_trace():
+    with _lock:
+        events = list(_events)
+    return {
+        'traceEvents': [{
+            'name': name,
+            'ph': 'X',
+            'ts': (start - _start) / 1000,
+            'dur': (end - start) / 1000,
+            'pid': pid,
+            'tid': tid,
+        } for name, start, end, pid, tid in events],
+        'displayTimeUnit': 'ms',
+    }
+
+
+def print_summary(content, file=sys.stderr):
+    print('Stage'.ljust(32) + 'count'.rjust(8) + 'total'.rjust(12) +
+          'p50'.rjust(10) + 'p99'.rjust(10),
+          file=file)
+    for name, s in sorted(content['spans'].items(),
+                          key=lambda item: -item[1]['total_ms']):
+        print(f'{name}'.ljust(32) + f'{s["count"]:8d}' +
+              f'{s["total_ms"]:10.1f}ms' + f'{s["p50_ms"]:8.2f}ms' +
+              f'{s["p99_ms"]:8.2f}ms',
+              file=file)
+    for name, value in sorted(content['counters'].items()):
+        print(f'{name}'.ljust(32) + f'{value:8d}', file=file)
+
+
+def dump():
+    # Registered at exit. Pool workers leave without running it, their
+    # spans are merged on the main process with their results.
+    if os.getpid() != _pid:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(profile_path)
+    content = summary()
+    print_summary(content)
+    if summary_path:
+        with open(summary_path, 'w') as f:
+            json.dump(content, f, indent=2)
+    if trace_path:
+        with open(trace_path, 'w') as f:
+            json.dump(chrome_trace(), f)
+
+
+if enabled:
+    if profile == 'cprofile':
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif profile == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+    atexit.register(dump)
@@ -0,0 +1,123 @@
+import os
+import sqlite3
+
+hash_offset = 1 << 64
+
+
+def to_signed(h):
+    # SQLite integers are signed 64 bits
+    return h - hash_offset if h >= hash_offset >> 1 else h
+
+
+def to_unsigned(h):
+    return h % hash_offset
+
+
+class MetricsIndex:
+    # Image metrics of filter_images stored by path, valid while the file
+    # size and modification time are the same.
+
+    def __init__(self, path='images/metrics.sqlite'):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS metrics (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash_kind TEXT NOT NULL,
+                hash INTEGER NOT NULL,
+                entropy REAL NOT NULL,
+                brightness REAL NOT NULL,
+                blur_kind TEXT,
+                blur REAL
+            )''')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS scores (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                model_key TEXT NOT NULL,
+                margin REAL NOT NULL
+            )''')
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, img_path, hash_kind='ahash', blur_kind=None):
+        # Stored metrics of the file, or None if they are missing, stale or
+        # computed with other hash or blur settings.
+        row = self.connection.execute(
+            'SELECT size, mtime_ns, hash_kind, hash, entropy, brightness, ' +
+            'blur_kind, blur FROM metrics WHERE path = ?',
+            (img_path, )).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, stored_hash_kind, h, entropy, brightness, \
+            stored_blur_kind, blur_score = row
+        stat = os.stat(img_path)
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        if stored_hash_kind != hash_kind:
+            return None
+        if blur_kind is not None and stored_blur_kind != blur_kind:
+            return None
+        return {
+            'entropy': entropy,
+            'blur': blur_score,
+            'hash': to_unsigned(h),
+            'brightness': brightness,
+        }
+
+    def put(self, items, hash_kind='ahash', blur_kind=None):
+        rows = []
+        for img_path, metrics in items:
+            stat = os.stat(img_path)
+            rows.append((img_path, stat.st_size, stat.st_mtime_ns, hash_kind,
+                         to_signed(metrics['hash']), metrics['entropy'],
+                         metrics['brightness'],
+                         blur_kind if metrics['blur'] is not None else None,
+                         metrics['blur']))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO metrics ' +
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def get_score(self, img_path, model_key):
+        # Decision margin of the image by the model, or None if missing or
+        # stale
+        row = self.connection.execute(
+            'SELECT size, mtime_ns, model_key, margin FROM scores ' +
+            'WHERE path = ?', (img_path, )).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, stored_model_key, margin = row
+        stat = os.stat(img_path)
+        if (size, mtime_ns, stored_model_key) != (stat.st_size,
+                                                  stat.st_mtime_ns,
+                                                  model_key):
+            return None
+        return margin
+
+    def put_scores(self, items, model_key):
+        rows = []
+        for img_path, margin in items:
+            stat = os.stat(img_path)
+            rows.append((img_path, stat.st_size, stat.st_mtime_ns, model_key,
+                         margin))
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)', rows)
+        self.connection.commit()
+
+    def rename(self, old_path, new_path):
+        # os.rename keeps size and modification time
+        self.connection.execute(
+            'INSERT OR REPLACE INTO metrics SELECT ?, size, mtime_ns, ' +
+            'hash_kind, hash, entropy, brightness, blur_kind, blur ' +
+            'FROM metrics WHERE path = ?', (new_path, old_path))
+        self.connection.execute('DELETE FROM metrics WHERE path = ?',
+                                (old_path, ))
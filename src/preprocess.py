@@ -0,0 +1,159 @@
+import math
+import pathlib
+import time
+
+import cv2 as cv
+import numpy as np
+
+from params import win_size
+
+bbox_scale = 8
+threshold_value = 8
+
+
+def to_gray(im):
+    return im if im.ndim == 2 else cv.cvtColor(im, cv.COLOR_BGR2GRAY)
+
+
+def reference_bounding_box(im):
+    # Bounding box on the full resolution image, the original crop
+    gray = to_gray(im)
+    gaussian = cv.GaussianBlur(gray, (21, 21), 0)
+    _, thresh = cv.threshold(gaussian, threshold_value, 255,
+                             cv.THRESH_BINARY)
+    x, y, w, h = cv.boundingRect(thresh)
+    return (x, y, w, h) if w and h else None
+
+
+def reduced_mask(im, scale=8):
+    # Thresholded copy of the image downscaled by `scale`, blurred with the
+    # 21x21 kernel of the reference crop scaled down too.
+    h, w = im.shape[:2]
+    small = cv.resize(im, (max(1, w // scale), max(1, h // scale)),
+                      interpolation=cv.INTER_AREA)
+    small = to_gray(small)
+    ksize = max(3, (21 // scale) | 1)
+    small = cv.GaussianBlur(small, (ksize, ksize), 0)
+    return small > threshold_value
+
+
+def scale_box(box, mask_shape, im_shape):
+    x, y, w, h = box
+    sx = im_shape[1] / mask_shape[1]
+    sy = im_shape[0] / mask_shape[0]
+    x0 = int(x * sx)
+    y0 = int(y * sy)
+    x1 = min(im_shape[1], math.ceil((x + w) * sx))
+    y1 = min(im_shape[0], math.ceil((y + h) * sy))
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def bounding_box(im, scale=8):
+    mask = reduced_mask(im, scale)
+    x, y, w, h = cv.boundingRect(mask.view(np.uint8))
+    if not w or not h:
+        return None
+    return scale_box((x, y, w, h), mask.shape, im.shape)
+
+
+def bounding_boxes(images, scale=8):
+    # bounding_box of images of the same size, computed on a stack of masks
+    masks = np.stack([reduced_mask(im, scale) for im in images])
+    rows = masks.any(axis=2)
+    cols = masks.any(axis=1)
+    found = rows.any(axis=1)
+    y0 = rows.argmax(axis=1)
+    y1 = rows.shape[1] - rows[:, ::-1].argmax(axis=1)
+    x0 = cols.argmax(axis=1)
+    x1 = cols.shape[1] - cols[:, ::-1].argmax(axis=1)
+    return [
+        scale_box((x0[i], y0[i], x1[i] - x0[i], y1[i] - y0[i]),
+                  masks.shape[1:], images[i].shape) if found[i] else None
+        for i in range(len(images))
+    ]
+
+
+def crop(im, box, win_size):
+    if box is None:
+        return None
+    x, y, w, h = box
+    cropped = im[y:y + h, x:x + w]
+    if cropped.shape[0:2][::-1] != win_size:
+        cropped = cv.resize(cropped,
+                            win_size,
+                            interpolation=cv.INTER_LINEAR)
+    return cropped
+
+
+def preprocess(im, win_size, scale=bbox_scale):
+    # Crops the image to the bounding box of its non dark pixels and
+    # resizes it to `win_size`. Returns None if the image is all dark.
+    return crop(im, bounding_box(im, scale), win_size)
+
+
+def preprocess_batch(images, win_size, scale=bbox_scale):
+    if len({im.shape for im in images}) > 1:
+        return [preprocess(im, win_size, scale) for im in images]
+    return [
+        crop(im, box, win_size)
+        for im, box in zip(images, bounding_boxes(images, scale))
+    ]
+
+
+def preprocess_description(scale=bbox_scale):
+    # Part of the feature store key, so features are recomputed when the
+    # preprocessing changes
+    return {'preprocess': f'bbox/{scale}/{threshold_value}'}
+
+
+def iou(a, b):
+    if a is None or b is None:
+        return float(a is None and b is None)
+    x0 = max(a[0], b[0])
+    y0 = max(a[1], b[1])
+    x1 = min(a[0] + a[2], b[0] + b[2])
+    y1 = min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, x1 - x0) * max(0, y1 - y0)
+    return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+
+def compare(imgs, win_size, scale=bbox_scale, batch_size=32):
+    images = [cv.imread(p) for p in imgs]
+    images = [im for im in images if im is not None]
+
+    start = time.perf_counter()
+    reference = [reference_bounding_box(im) for im in images]
+    for im, box in zip(images, reference):
+        crop(im, box, win_size)
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    boxes = [bounding_box(im, scale) for im in images]
+    for im, box in zip(images, boxes):
+        crop(im, box, win_size)
+    fast_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(0, len(images), batch_size):
+        preprocess_batch(images[i:i + batch_size], win_size, scale)
+    batch_time = time.perf_counter() - start
+
+    ious = [iou(a, b) for a, b in zip(reference, boxes)]
+    n = max(1, len(images))
+    print(f'{len(images)} images, bounding box on 1/{scale} scale:')
+    print(f'Reference: {reference_time * 1000 / n:.2f}ms per image')
+    print(f'Reduced: {fast_time * 1000 / n:.2f}ms per image')
+    print(f'Reduced batch: {batch_time * 1000 / n:.2f}ms per image')
+    if ious:
+        print(f'IoU with reference: mean {np.mean(ious):.4f}, ' +
+              f'min {np.min(ious):.4f}')
+    return ious
+
+
+if __name__ == '__main__':
+    imgs = [
+        str(p) for directory in ('images/positives', 'images/negatives')
+        for p in sorted(pathlib.Path(directory).iterdir())
+        if p.suffix in ('.jpg', '.png')
+    ]
+    compare(imgs, win_size)
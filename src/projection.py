@@ -0,0 +1,80 @@
+import cv2 as cv
+import numpy as np
+
+
+class Projection:
+    # PCA of the HOG features, (x - mean) @ eigenvectors', optionally
+    # whitened by scaling each component to unit variance.
+
+    kind = 'pca'
+
+    def __init__(self, mean, eigenvectors, scale=None):
+        self.mean = np.float32(mean).reshape(1, -1)
+        self.eigenvectors = np.float32(eigenvectors)
+        self.scale = None if scale is None else np.float32(scale).reshape(
+            1, -1)
+
+    @property
+    def input_len(self):
+        return self.eigenvectors.shape[1]
+
+    @property
+    def n_components(self):
+        return self.eigenvectors.shape[0]
+
+    @classmethod
+    def fit(cls, data, n_components=None, variance=0.95, whiten=False):
+        # Keeps `n_components` components or, if it is None, the fewest
+        # components that retain `variance` of the variance
+        data = np.asarray(data, np.float32).reshape(len(data), -1)
+        if n_components is None:
+            mean, eigenvectors, eigenvalues = cv.PCACompute2(
+                data, None, retainedVariance=variance)
+        else:
+            mean, eigenvectors, eigenvalues = cv.PCACompute2(
+                data, None, maxComponents=n_components)
+        eigenvalues = eigenvalues.ravel()
+        scale = None
+        if whiten:
+            floor = eigenvalues[0] * 1e-6
+            scale = 1 / np.sqrt(np.maximum(eigenvalues, floor))
+        projection = cls(mean, eigenvectors, scale)
+        total = np.mean(np.sum(np.square(data - mean), axis=1))
+        projection.retained_variance = float(eigenvalues.sum() / total)
+        return projection
+
+    def transform(self, samples):
+        samples = np.float32(samples).reshape(len(samples), -1)
+        projected = (samples - self.mean) @ self.eigenvectors.T
+        if self.scale is not None:
+            projected *= self.scale
+        return projected
+
+    def save(self, path):
+        content = {
+            'kind': self.kind,
+            'mean': self.mean,
+            'eigenvectors': self.eigenvectors,
+        }
+        if self.scale is not None:
+            content['scale'] = self.scale
+        np.savez(path, **content)
+
+
+class ProjectedModel:
+    # Model trained on projected features, with the predict() interface of
+    # cv.ml.SVM on the HOG features
+
+    def __init__(self, projection, model):
+        self.projection = projection
+        self.model = model
+
+    def predict(self, samples, flags=0):
+        return self.model.predict(self.projection.transform(samples),
+                                  flags=flags)
+
+
+def load_projection(path):
+    content = np.load(path)
+    scale = content['scale'] if 'scale' in content else None
+    return Projection(content['mean'], content['eigenvectors'], scale)
@@ -0,0 +1,89 @@
+import os
+import sys
+
+import cv2 as cv
+import numpy as np
+
+from classifier import engine, engine_paths, load_models, read_paths
+from fast_svm import positive_margin
+
+scale_factor = 1.25
+max_levels = 8
+win_stride = None  # None for the HOG block stride
+score_threshold = 0.0
+nms_threshold = 0.3
+
+
+def pyramid(im, win_size, scale_factor=1.25, max_levels=8):
+    # Yields (scale, image) from the largest level down, while the window
+    # fits. Images smaller than the window start scaled up to fit it.
+    h, w = im.shape[:2]
+    scale = max(1.0, win_size[0] / w, win_size[1] / h)
+    for _ in range(max_levels):
+        size = (round(w * scale), round(h * scale))
+        if size[0] < win_size[0] or size[1] < win_size[1]:
+            break
+        level = im if scale == 1.0 else cv.resize(
+            im, size, interpolation=cv.INTER_AREA
+            if scale < 1 else cv.INTER_LINEAR)
+        yield scale, level
+        scale /= scale_factor
+
+
+def window_locations(size, win_size, stride):
+    return [(x, y) for y in range(0, size[1] - win_size[1] + 1, stride[1])
+            for x in range(0, size[0] - win_size[0] + 1, stride[0])]
+
+
+def scan_image(im,
+               hog,
+               svm,
+               scale_factor=1.25,
+               max_levels=8,
+               win_stride=None,
+               score_threshold=0.0,
+               nms_threshold=0.3):
+    # Returns [((x, y, w, h), margin)] of the positive windows kept by
+    # non-maximum suppression, in original image coordinates.
+    win_size = hog.winSize
+    stride = win_stride or hog.blockStride
+    boxes = []
+    features = []
+    for scale, level in pyramid(im, win_size, scale_factor, max_levels):
+        # Without explicit locations OpenCV enumerates the same row-major
+        # grid of windows and caches the block histograms they share
+        locations = window_locations(level.shape[1::-1], win_size, stride)
+        descriptors = hog.compute(level, stride, (0, 0))
+        features.append(descriptors.reshape(len(locations), -1))
+        boxes.extend((round(x / scale), round(y / scale),
+                      round(win_size[0] / scale), round(win_size[1] / scale))
+                     for x, y in locations)
+    if not boxes:
+        return []
+
+    margins = positive_margin(svm, np.concatenate(features))
+    positives = np.flatnonzero(margins > score_threshold)
+    keep = cv.dnn.NMSBoxes([boxes[i] for i in positives],
+                           [float(margins[i]) for i in positives],
+                           score_threshold, nms_threshold)
+    keep = positives[np.ravel(keep).astype(int)] if len(keep) else []
+    return [(boxes[i], float(margins[i])) for i in keep]
+
+
+if __name__ == '__main__':
+    hog, svm, mode = load_models(svm_path=engine_paths[engine])
+    print('Detections:')
+    for file_path in read_paths(sys.stdin):
+        im = mode.imread(file_path) if os.path.isfile(file_path) else None
+        if im is None:
+            print(f'Opencv do not opened {file_path}.')
+            continue
+        for (x, y, w, h), margin in scan_image(im, hog, svm, scale_factor,
+                                               max_levels, win_stride,
+                                               score_threshold,
+                                               nms_threshold):
+            # Boxes on the image decoded at full size
+            x, y, w, h = (v * mode.reduction for v in (x, y, w, h))
+            print(f'{file_path}'.ljust(70) + f'{x:6d} {y:6d} {w:6d} {h:6d}' +
+                  f'{margin:10.3f}')
+        sys.stdout.flush()
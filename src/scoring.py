@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+
+from classifier import load_models, projection_path
+from fast_svm import positive_margin
+from metrics_index import MetricsIndex
+from preprocess import preprocess
+
+
+class ModelScorer:
+    # Decision margins of images by the saved models, cached on the metrics
+    # index until the image or the model files change.
+
+    def __init__(self,
+                 hog_path='models/hog_model.xml',
+                 svm_path='models/svm_model.dat',
+                 index_path='images/metrics.sqlite',
+                 batch_size=64):
+        self.hog_path = hog_path
+        self.svm_path = svm_path
+        self.index_path = index_path
+        self.batch_size = batch_size
+        self.hog = None
+        self.svm = None
+        self.mode = None
+        self.key = None
+
+    def model_key(self):
+        paths = [self.hog_path, self.svm_path]
+        if os.path.isfile(projection_path):
+            paths.append(projection_path)
+        stats = [os.stat(p) for p in paths]
+        return ':'.join(f'{s.st_size}-{s.st_mtime_ns}' for s in stats)
+
+    def changed(self):
+        try:
+            return self.model_key() != self.key
+        except OSError:
+            return False
+
+    def load(self):
+        key = self.model_key()
+        self.hog, self.svm, self.mode = load_models(self.hog_path,
+                                                    self.svm_path)
+        self.key = key
+
+    def features(self, img_path):
+        im = self.mode.imread(img_path)
+        if im is None:
+            return None
+        im = preprocess(im, self.hog.winSize)
+        if im is None:
+            return None
+        return self.hog.compute(im)
+
+    def score(self, img_paths):
+        # Yields lists of (path, margin) as each batch is scored. The index
+        # is opened here, so it belongs to the thread that scores.
+        index = MetricsIndex(self.index_path)
+        try:
+            cached = []
+            missing = []
+            for img_path in img_paths:
+                if not os.path.isfile(img_path):
+                    continue
+                margin = index.get_score(img_path, self.key)
+                if margin is None:
+                    missing.append(img_path)
+                else:
+                    cached.append((img_path, margin))
+            if cached:
+                yield cached
+
+            for i in range(0, len(missing), self.batch_size):
+                paths = []
+                features = []
+                for img_path in missing[i:i + self.batch_size]:
+                    f = self.features(img_path)
+                    if f is not None:
+                        paths.append(img_path)
+                        features.append(f)
+                if not paths:
+                    continue
+                margins = positive_margin(
+                    self.svm,
+                    np.float32(features).reshape(len(features), -1))
+                scores = list(zip(paths, map(float, margins)))
+                index.put_scores(scores, self.key)
+                yield scores
+        finally:
+            index.close()
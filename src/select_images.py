@@ -5,13 +5,27 @@ from PIL import ImageTk, Image
 import pathlib
 import os
 import math
+import threading
 import tkinter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tkinter.constants import BOTH, LEFT
 
+from scoring import ModelScorer
+
+# Order the images ahead by the model's decision margin, closest to zero first
+uncertainty_order = False
 
-class ImageSelector:
 
-    def __init__(self, positives_dir, negatives_dir):
+class ImageSelector:
+    prefetch_next = 5
+    prefetch_previous = 2
+    cache_size = 12
+    resize_delay_ms = 150
+    scores_poll_ms = 500
+    model_check_s = 5
+
+    def __init__(self, positives_dir, negatives_dir, uncertainty_order=False):
         self.positives_dir = positives_dir
         self.negatives_dir = negatives_dir
         self.undefined_directory = None
@@ -23,6 +37,17 @@ class ImageSelector:
         self.images = None
         self.current = None
         self.journal = None
+        self.renderer = None
+        self.cache = OrderedDict()
+        self.rendered_width = None
+        self.pending_update = None
+        self.uncertainty_order = uncertainty_order
+        self.scores = {}
+        self.scored_batches = 0
+        self.scored_passes = 0
+        self.shown_batches = 0
+        self.ordered_passes = 0
+        self.closed = threading.Event()
 
     def build_button(self, frame, text, command, **kwargs):
         button = tkinter.Button(frame,
@@ -48,7 +73,7 @@ class ImageSelector:
 
         main_frame = tkinter.Frame(self.tk, borderwidth=0)
         main_frame.pack(fill=BOTH)
-        main_frame.bind('<Configure>', lambda e: self.update_ui())
+        main_frame.bind('<Configure>', lambda e: self.on_configure())
 
         self.left_image_label = tkinter.Label(main_frame)
         self.left_image_label.grid(column=0, row=0, rowspan=2)
@@ -95,7 +120,70 @@ class ImageSelector:
                                         lambda: self.undo())
         undo_button.pack(side=LEFT, **padding)
 
+    def render(self, image_path, win_width):
+        # Runs on the renderer thread: everything but the PhotoImage
+        image = Image.open(image_path)
+        image.load()
+        return {
+            'left':
+            self.image_resize(image, width=round(0.65 * win_width)),
+            'right':
+            self.image_gradient(
+                self.image_resize(image, width=round(0.35 * win_width))),
+            'thumb':
+            self.image_resize(image, width=round(0.25 * win_width)),
+            'brightness':
+            self.image_brightness(image),
+            'contrast':
+            self.image_contrast(image),
+        }
+
+    def request(self, image_path, win_width):
+        key = (image_path, win_width)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            self.cache[key] = self.renderer.submit(self.render, image_path,
+                                                   win_width)
+            while len(self.cache) > self.cache_size:
+                _, future = self.cache.popitem(last=False)
+                future.cancel()
+        return self.cache[key]
+
+    def prefetch(self, win_width):
+        wanted = [
+            i for i in range(self.current + 1, self.current +
+                             self.prefetch_next + 1)
+        ] + [
+            i for i in range(self.current - 1, self.current -
+                             self.prefetch_previous - 1, -1)
+        ]
+        wanted = [
+            self.images[i] for i in wanted
+            if 0 <= i < len(self.images) and os.path.isfile(self.images[i])
+        ]
+
+        # Renders not started and no longer near the current image (e.g.
+        # after skipping 100 images) are cancelled.
+        keys = {(image_path, win_width) for image_path in wanted}
+        keys.add((self.images[self.current], win_width))
+        for key, future in list(self.cache.items()):
+            if key not in keys and future.cancel():
+                del self.cache[key]
+
+        for image_path in wanted:
+            self.request(image_path, win_width)
+
+    def on_configure(self):
+        if max(self.tk.winfo_width(), 100) == self.rendered_width:
+            return
+        if self.pending_update is not None:
+            self.tk.after_cancel(self.pending_update)
+        self.pending_update = self.tk.after(self.resize_delay_ms,
+                                            self.update_ui)
+
     def update_ui(self):
+        self.pending_update = None
         if self.current < 0 or self.current >= len(self.images):
             return
 
@@ -106,23 +194,68 @@ class ImageSelector:
         win_width = self.tk.winfo_width()
 
         win_width = max(win_width, 100)
-
-        image = Image.open(current_image)
-
-        self.left_image_label.image = ImageTk.PhotoImage(
-            self.image_resize(image, width=round(0.65 * win_width)))
+        self.rendered_width = win_width
+
+        future = self.request(current_image, win_width)
+        self.prefetch(win_width)
+        rendered = future.result()
+        if 'photos' not in rendered:
+            rendered['photos'] = [
+                ImageTk.PhotoImage(rendered[name])
+                for name in ('left', 'right', 'thumb')
+            ]
+        left, right, thumb = rendered['photos']
+
+        self.left_image_label.image = left
         self.left_image_label.configure(image=self.left_image_label.image)
-        self.right_image_label.image = ImageTk.PhotoImage(
-            self.image_gradient(
-                self.image_resize(image, width=round(0.35 * win_width))))
+        self.right_image_label.image = right
         self.right_image_label.configure(image=self.right_image_label.image)
-        self.thumb_image_label.image = ImageTk.PhotoImage(
-            self.image_resize(image, width=round(0.25 * win_width)))
+        self.thumb_image_label.image = thumb
         self.thumb_image_label.configure(image=self.thumb_image_label.image)
+        prediction = ''
+        margin = self.scores.get(current_image)
+        if margin is not None:
+            label = 'POSITIVE' if margin > 0 else 'NEGATIVE'
+            prediction = f' - Model: {label} ({margin:+.03f})'
         self.information_label.configure(
             text=f'{filename} ({self.current+1}/{len(self.images)}) - ' +
-            f'Brightness: {self.image_brightness(image)}/255 - ' +
-            f'Contrast (Entropy): {self.image_contrast(image):.02f}')
+            f'Brightness: {rendered["brightness"]}/255 - ' +
+            f'Contrast (Entropy): {rendered["contrast"]:.02f}' + prediction)
+
+    def score_images(self):
+        # Runs on the scoring thread. Scores the images ahead of the current
+        # one, and again whenever the model files change.
+        scorer = ModelScorer()
+        while not self.closed.is_set():
+            if scorer.changed():
+                try:
+                    scorer.load()
+                except (OSError, ValueError, cv.error) as e:
+                    print(f'Images not scored, model not loaded: {e}')
+                    return
+                pending = list(self.images[self.current + 1:])
+                for scores in scorer.score(pending):
+                    if self.closed.is_set():
+                        return
+                    self.scores.update(scores)
+                    self.scored_batches += 1
+                self.scored_passes += 1
+            self.closed.wait(self.model_check_s)
+
+    def poll_scores(self):
+        if self.ordered_passes != self.scored_passes:
+            # Only the images ahead are reordered, undo is not affected
+            self.ordered_passes = self.scored_passes
+            self.shown_batches = self.scored_batches
+            self.images[self.current + 1:] = sorted(
+                self.images[self.current + 1:],
+                key=lambda p: (p not in self.scores,
+                               abs(self.scores.get(p, 0))))
+            self.update_ui()
+        elif self.shown_batches != self.scored_batches:
+            self.shown_batches = self.scored_batches
+            self.update_ui()
+        self.tk.after(self.scores_poll_ms, self.poll_scores)
 
     def next_image(self):
         self.current += 1
@@ -177,6 +310,11 @@ class ImageSelector:
             self.update_ui()
 
     def close(self):
+        self.closed.set()
+        if self.renderer is not None:
+            for future in self.cache.values():
+                future.cancel()
+            self.renderer.shutdown(wait=False)
         self.tk.destroy()
 
     def select(self, directory):
@@ -191,10 +329,15 @@ class ImageSelector:
         self.images = image_files
         self.current = -1
         self.journal = [('begin', None)]
+        self.renderer = ThreadPoolExecutor(1)
+        self.cache.clear()
 
         self.create_widgets()
         self.next_image()
         self.update_ui()
+        if self.uncertainty_order:
+            threading.Thread(target=self.score_images, daemon=True).start()
+            self.tk.after(self.scores_poll_ms, self.poll_scores)
         self.tk.mainloop()
 
     def image_brightness(self, image):
@@ -229,5 +372,7 @@ class ImageSelector:
 
 
 if __name__ == '__main__':
-    selector = ImageSelector('images/positives', 'images/negatives')
+    selector = ImageSelector('images/positives',
+                             'images/negatives',
+                             uncertainty_order=uncertainty_order)
     selector.select('images/undefined')
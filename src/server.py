@@ -0,0 +1,209 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2 as cv
+import numpy as np
+
+from classifier import load_models, projection_path
+from preprocess import preprocess
+
+host = '127.0.0.1'
+port = 8080
+max_batch_size = 64
+max_wait = 0.005
+reload_interval = 1.0
+
+
+class MicroBatcher:
+
+    def __init__(self,
+                 hog_path='models/hog_model.xml',
+                 svm_path='models/svm_model.dat',
+                 max_batch_size=64,
+                 max_wait=0.005,
+                 reload_interval=1.0):
+        self.hog_path = hog_path
+        self.svm_path = svm_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.reload_interval = reload_interval
+        self.mtimes = self.model_mtimes()
+        self.models = load_models(hog_path, svm_path)
+        self.last_check = time.monotonic()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def model_mtimes(self):
+        projection_mtime = None
+        if os.path.isfile(projection_path):
+            projection_mtime = os.stat(projection_path).st_mtime_ns
+        return (os.stat(self.hog_path).st_mtime_ns,
+                os.stat(self.svm_path).st_mtime_ns, projection_mtime)
+
+    def reload(self):
+        self.last_check = time.monotonic()
+        try:
+            mtimes = self.model_mtimes()
+            if mtimes == self.mtimes:
+                return
+            models = load_models(self.hog_path, self.svm_path)
+        except (OSError, ValueError, cv.error) as e:
+            # Model files may be half written, try again on the next check
+            print(f'Models not reloaded: {e}')
+            return
+        self.models = models
+        self.mtimes = mtimes
+        print(f'Models reloaded from {self.hog_path} and {self.svm_path}')
+
+    def submit(self, features, models):
+        future = Future()
+        self.requests.put((features, models, future))
+        return future
+
+    def next_batch(self):
+        try:
+            batch = [self.requests.get(timeout=self.reload_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if time.monotonic() - self.last_check >= self.reload_interval:
+                self.reload()
+
+            # Requests computed with models replaced by a reload are
+            # predicted with the SVM that matches their HOG descriptor.
+            groups = {}
+            for features, models, future in batch:
+                groups.setdefault(id(models), (models, []))[1].append(
+                    (features, future))
+            for (_, svm, _), items in groups.values():
+                # Any error is given to the requests, the thread keeps
+                # serving the next batches
+                try:
+                    features = np.float32([f for f, _ in items]).reshape(
+                        len(items), -1)
+                    result = svm.predict(features)[1]
+                except Exception as e:
+                    for _, future in items:
+                        future.set_exception(e)
+                    continue
+                for (_, future), label in zip(items, result):
+                    future.set_result(bool(label[0] == 1))
+
+    def classify(self, im, models=None):
+        # `im` decoded in the mode of `models`, the current ones by default
+        models = models or self.models
+        hog, _, _ = models
+        im = preprocess(im, hog.winSize)
+        if im is None:
+            raise ValueError('image is too dark')
+        return self.submit(hog.compute(im), models)
+
+
+class ClassificationHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def submit_path(self, path):
+        models = self.batcher.models
+        im = models[2].imread(path)
+        if im is None:
+            return 'image could not be opened'
+        try:
+            return self.batcher.classify(im, models)
+        except ValueError as e:
+            return str(e)
+
+    def classify_paths(self, paths):
+        # Submit every image before waiting, so they share batches
+        pending = [(path, self.submit_path(path)) for path in paths]
+        results = []
+        for path, future in pending:
+            if isinstance(future, str):
+                results.append({'path': path, 'error': future})
+                continue
+            try:
+                results.append({'path': path, 'positive': future.result()})
+            except Exception as e:
+                results.append({'path': path, 'error': str(e)})
+        return results
+
+    def classify_bytes(self, data):
+        models = self.batcher.models
+        im = models[2].imdecode(data)
+        if im is None:
+            return 400, {'error': 'image could not be decoded'}
+        try:
+            return 200, {
+                'positive': self.batcher.classify(im, models).result()
+            }
+        except Exception as e:
+            return 400, {'error': str(e)}
+
+    def do_POST(self):
+        if self.path != '/classify':
+            return self.send_json(404, {'error': 'not found'})
+
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type') == 'application/json':
+            try:
+                paths = json.loads(data)['paths']
+            except (ValueError, KeyError, TypeError):
+                paths = None
+            if not isinstance(paths, list) or not all(
+                    isinstance(p, str) for p in paths):
+                return self.send_json(400,
+                                      {'error': 'expected {"paths": [...]}'})
+            return self.send_json(200,
+                                  {'results': self.classify_paths(paths)})
+
+        status, content = self.classify_bytes(data)
+        self.send_json(status, content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=8080, **batcher_options):
+    ClassificationHandler.batcher = MicroBatcher(**batcher_options)
+    server = ThreadingHTTPServer((host, port), ClassificationHandler)
+    print(f'Serving on http://{host}:{port}/classify')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    serve(host,
+          port,
+          max_batch_size=max_batch_size,
+          max_wait=max_wait,
+          reload_interval=reload_interval)
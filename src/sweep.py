@@ -0,0 +1,294 @@
+import csv
+import os
+import time
+from multiprocessing import Pool
+
+import cv2 as cv
+import numpy as np
+from alive_progress import alive_bar
+
+import grid_search
+from dataset import Dataset
+from decode import DecodeMode
+from feature_store import FeatureStore, file_digest
+from params import n_bins
+from preprocess import preprocess, preprocess_description
+from training import features_dir, hog_setup, image_paths, setup_svm
+
+
+def mode_config(mode):
+    # Geometry of params.py for images decoded in `mode` ('gray/1', ...)
+    win_size, cell_size, block_size, block_stride = DecodeMode.parse(
+        mode).geometry()
+    return {
+        'win_size': win_size,
+        'cell_size': cell_size,
+        'block_size': block_size,
+        'block_stride': block_stride,
+        'n_bins': n_bins,
+        'decode': mode,
+    }
+
+
+# HOG geometries to compare, the first one is the one on params.py. Images
+# are decoded in colour unless 'decode' sets other mode of decode.py.
+configurations = [
+    {
+        'win_size': (1280, 720),
+        'cell_size': (256, 90),
+        'block_size': (512, 180),
+        'block_stride': (256, 90),
+        'n_bins': 9,
+    },
+    {
+        'win_size': (1280, 720),
+        'cell_size': (128, 90),
+        'block_size': (256, 180),
+        'block_stride': (128, 90),
+        'n_bins': 9,
+    },
+    {
+        'win_size': (1280, 720),
+        'cell_size': (256, 90),
+        'block_size': (512, 180),
+        'block_stride': (256, 90),
+        'n_bins': 18,
+    },
+    {
+        'win_size': (640, 360),
+        'cell_size': (128, 45),
+        'block_size': (256, 90),
+        'block_stride': (128, 45),
+        'n_bins': 9,
+    },
+    mode_config('gray/1'),
+    mode_config('color/2'),
+    mode_config('gray/2'),
+]
+n_workers = os.cpu_count()
+search_k_fold = 5
+search_refine = 1
+timing_images = 32
+report_path = 'models/sweep_last.csv'
+
+
+def config_hog(config):
+    return hog_setup(config['win_size'], config['cell_size'],
+                     config['n_bins'], config['block_size'],
+                     config['block_stride'])
+
+
+def config_mode(config):
+    return DecodeMode.parse(config.get('decode', 'color/1'))
+
+
+def config_store(config):
+    return FeatureStore(features_dir, config_hog(config), {
+        **preprocess_description(),
+        **config_mode(config).description()
+    })
+
+
+def config_name(config):
+    mode = f' {config["decode"]}' if 'decode' in config else ''
+    return (f'win {config["win_size"][0]}x{config["win_size"][1]} ' +
+            f'cell {config["cell_size"][0]}x{config["cell_size"][1]} ' +
+            f'block {config["block_size"][0]}x{config["block_size"][1]} ' +
+            f'stride {config["block_stride"][0]}x' +
+            f'{config["block_stride"][1]} bins {config["n_bins"]}{mode}')
+
+
+_worker_hogs = None
+_worker_mode = None
+
+
+def init_worker(group):
+    global _worker_hogs, _worker_mode
+    cv.setNumThreads(1)
+    _worker_hogs = [config_hog(config) for config in group]
+    _worker_mode = config_mode(group[0])
+
+
+def group_features(job, hogs=None, mode=None):
+    # One decode and preprocess for every configuration of a window size
+    # and decode mode. `job` is (img_path, indices of the configurations
+    # missing it).
+    img_path, indices = job
+    hogs = hogs or _worker_hogs
+    mode = mode or _worker_mode
+    im = mode.imread(img_path)
+    assert (im is not None)
+    im = preprocess(im, hogs[0].winSize)
+    if im is None:
+        return [None] * len(indices)
+    return [hogs[i].compute(im) for i in indices]
+
+
+def extract_group(group, stores, images, digests, n_workers=1):
+    # Features of the images missing on any store of the configurations
+    # with the same window size
+    missing = {}
+    for img_path, digest in zip(images, digests):
+        indices = [i for i, store in enumerate(stores) if digest not in store]
+        if indices and digest not in missing:
+            missing[digest] = (img_path, indices)
+    jobs = list(missing.values())
+    if not jobs:
+        return
+
+    pending = [([], []) for _ in stores]
+    with alive_bar(len(jobs)) as bar:
+        if n_workers > 1:
+            pool = Pool(n_workers, init_worker, (group, ))
+            chunksize = max(1, min(16, len(jobs) // (n_workers * 4)))
+            results = pool.imap(group_features, jobs, chunksize)
+        else:
+            pool = None
+            hogs = [config_hog(config) for config in group]
+            mode = config_mode(group[0])
+            results = (group_features(job, hogs, mode) for job in jobs)
+        for digest, (_, indices), features in zip(missing, jobs, results):
+            for i, f in zip(indices, features):
+                pending[i][0].append(digest)
+                pending[i][1].append(f)
+            bar()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    for store, (store_digests, store_features) in zip(stores, pending):
+        store.append(store_digests, store_features)
+
+
+def extraction_times(group, images):
+    # Decode and preprocess time per image, shared by the group, and HOG
+    # time per image of each configuration
+    hogs = [config_hog(config) for config in group]
+    mode = config_mode(group[0])
+    start = time.perf_counter()
+    cropped = [preprocess(mode.imread(p), hogs[0].winSize) for p in images]
+    cropped = [im for im in cropped if im is not None]
+    decode_time = (time.perf_counter() - start) / max(1, len(images))
+    hog_times = []
+    for hog in hogs:
+        start = time.perf_counter()
+        for im in cropped:
+            hog.compute(im)
+        hog_times.append((time.perf_counter() - start) / max(1, len(cropped)))
+    return decode_time, hog_times
+
+
+def predict_latency(svm, data):
+    # Median time to predict a single image
+    latencies = []
+    for sample in data[:timing_images]:
+        start = time.perf_counter()
+        svm.predict(sample.reshape(1, -1))
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies))
+
+
+def evaluate(store, negatives_digests, positives_digests, n_workers=1):
+    digests = negatives_digests + positives_digests
+    rows = [store.row(d) for d in digests]
+    labels = [-1] * len(negatives_digests) + [1] * len(positives_digests)
+    valid = [i for i, row in enumerate(rows) if row >= 0]
+    dataset = Dataset.from_rows(store.matrix(), [rows[i] for i in valid],
+                                [labels[i] for i in valid])
+    train_data = dataset.train_data
+    train_labels = dataset.train_labels
+    test_data = dataset.test_data
+    test_labels = dataset.test_labels
+
+    C, gamma = grid_search.search(train_data,
+                                  train_labels,
+                                  n_workers,
+                                  k=search_k_fold,
+                                  refine=search_refine,
+                                  report_path=None)
+    svm = setup_svm(C=C, gamma=gamma)
+    svm.train(train_data, cv.ml.ROW_SAMPLE, train_labels)
+    result = svm.predict(test_data)[1]
+    accuracy = np.count_nonzero(result == test_labels) * 100.0 / result.size
+    return accuracy, C, gamma, predict_latency(svm, test_data)
+
+
+def write_report(rows, report_path):
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            'configuration', 'feature_len', 'accuracy', 'C', 'gamma',
+            'decode_ms', 'hog_ms', 'predict_ms'
+        ])
+        for row in rows:
+            writer.writerow([
+                row['name'], row['feature_len'], f'{row["accuracy"]:.2f}',
+                f'{row["C"]:.6g}', f'{row["gamma"]:.6g}',
+                f'{row["decode_time"] * 1000:.3f}',
+                f'{row["hog_time"] * 1000:.3f}',
+                f'{row["predict_time"] * 1000:.3f}'
+            ])
+
+
+def sweep(configurations, n_workers=1):
+    negatives_images = image_paths('images/negatives')
+    positives_images = image_paths('images/positives')
+    images = negatives_images + positives_images
+    print(f'Hashing {len(images)} images.')
+    digests = [file_digest(p) for p in images]
+    negatives_digests = digests[:len(negatives_images)]
+    positives_digests = digests[len(negatives_images):]
+
+    groups = {}
+    for i, config in enumerate(configurations):
+        key = (tuple(config['win_size']), str(config_mode(config)))
+        groups.setdefault(key, []).append(i)
+
+    rows = [None] * len(configurations)
+    for (win_size, mode), indices in groups.items():
+        group = [configurations[i] for i in indices]
+        stores = [config_store(config) for config in group]
+        print(f'Extracting features for window {win_size[0]}x{win_size[1]} ' +
+              f'decoded {mode} ({len(group)} configurations).')
+        extract_group(group, stores, images, digests, n_workers)
+        decode_time, hog_times = extraction_times(group,
+                                                  images[:timing_images])
+        for i, config, store, hog_time in zip(indices, group, stores,
+                                              hog_times):
+            print(f'Training {config_name(config)}.')
+            accuracy, C, gamma, predict_time = evaluate(
+                store, negatives_digests, positives_digests, n_workers)
+            rows[i] = {
+                'name': config_name(config),
+                'feature_len': store.feature_len,
+                'accuracy': accuracy,
+                'C': C,
+                'gamma': gamma,
+                'decode_time': decode_time,
+                'hog_time': hog_time,
+                'predict_time': predict_time,
+            }
+    return rows
+
+
+def print_report(rows):
+    # Extraction speedup and accuracy change are against the first row
+    base = rows[0]
+    base_time = base['decode_time'] + base['hog_time']
+    print('Configuration'.ljust(70) + 'length'.rjust(8) +
+          'accuracy'.rjust(10) + 'change'.rjust(8) + 'decode'.rjust(10) +
+          'hog'.rjust(10) + 'speedup'.rjust(9) + 'predict'.rjust(10))
+    for row in rows:
+        speedup = base_time / max(row['decode_time'] + row['hog_time'], 1e-9)
+        print(f'{row["name"]}'.ljust(70) + f'{row["feature_len"]:8d}' +
+              f'{row["accuracy"]:9.2f}%' +
+              f'{row["accuracy"] - base["accuracy"]:+8.2f}' +
+              f'{row["decode_time"] * 1000:8.2f}ms' +
+              f'{row["hog_time"] * 1000:8.2f}ms' + f'{speedup:8.2f}x' +
+              f'{row["predict_time"] * 1000:8.3f}ms')
+
+
+if __name__ == '__main__':
+    rows = sweep(configurations, n_workers)
+    print_report(rows)
+    write_report(rows, report_path)
+    print(f'Sweep report saved at {report_path}')
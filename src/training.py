@@ -1,12 +1,39 @@
+import os
 import pathlib
-import random
+import time
+from functools import partial
+from multiprocessing import Pool
 
 import cv2 as cv
 import numpy as np
 from alive_progress import alive_bar
 
-from params import win_size, cell_size, block_size, block_stride, n_bins, \
-    feature_len
+import grid_search
+import instrument
+from dataset import Dataset
+from decode import DecodeMode
+from fast_svm import CascadeModel, LinearPrefilter, NystroemSVM, reduce_svm
+from feature_store import FeatureStore, file_digest
+from params import n_bins, feature_len
+from preprocess import preprocess, preprocess_description
+from projection import Projection, ProjectedModel
+
+n_workers = os.cpu_count()
+# 'color' or 'gray', decoded reduced by 1, 2, 4 or 8 with the HOG geometry of
+# params.py scaled down to match
+decode_mode = 'color/1'
+features_dir = 'images/features'
+store_chunk = 256
+dataset_path = None  # .npy file to memory map the dataset, None on memory
+approx_components = 256
+reduced_size = None  # None to reduce within reduced_accuracy_loss
+reduced_accuracy_loss = 1.0
+reduced_float16 = True
+projection = None  # 'pca', 'whiten' or None to train on the HOG features
+pca_components = None  # None to keep pca_variance of the variance
+pca_variance = 0.95
+prefilter_C = 1.0
+cascade_recall = 0.99
 
 
 def hog_setup(win_size, cell_size, n_bins, block_size, block_stride):
@@ -25,105 +52,124 @@ def hog_setup(win_size, cell_size, n_bins, block_size, block_stride):
     return hog
 
 
-def preprocess(im, win_size):
-    gray = cv.cvtColor(im, cv.COLOR_BGR2GRAY)
-    gaussian = cv.GaussianBlur(gray, (21, 21), 0)
-    _, thresh = cv.threshold(gaussian, 8, 255, cv.THRESH_BINARY)
-    x, y, w, h = cv.boundingRect(thresh)
-    cropped = im[y:y + h, x:x + w]
-    if cropped.shape[0:2] == (0, 0):
+def hog_params(hog):
+    return (hog.winSize, hog.cellSize, hog.nbins, hog.blockSize,
+            hog.blockStride)
+
+
+_worker_hog = None
+_worker_mode = None
+
+
+def init_worker(params, mode):
+    global _worker_hog, _worker_mode
+    cv.setNumThreads(1)
+    _worker_hog = hog_setup(*params)
+    _worker_mode = DecodeMode.parse(mode)
+
+
+def compute_features(img_path, hog=None, mode=None):
+    if hog is None:
+        hog = _worker_hog
+        mode = _worker_mode
+    im = (mode or DecodeMode()).imread(img_path)
+    assert (im is not None)
+    with instrument.span('preprocess'):
+        im = preprocess(im, hog.winSize)
+    if im is None:
         return None
-    if cropped.shape[0:2][::-1] != win_size:
-        cropped = cv.resize(cropped, win_size, cv.INTER_LINEAR)
-    return cropped
+    with instrument.span('hog_compute'):
+        return hog.compute(im)
 
 
-def load_features(negatives_path, positives_path, hog):
-    negatives_dir = pathlib.Path(negatives_path)
-    positives_dir = pathlib.Path(positives_path)
-    negatives_images = [
-        name for name in map(str, negatives_dir.iterdir())
-        if name.endswith('.jpg') or name.endswith('.png')
-    ]
-    positives_images = [
-        name for name in map(str, positives_dir.iterdir())
+def parallel_map(function, items, hog, n_workers=1, mode=None):
+    mode = mode or DecodeMode()
+    if n_workers > 1:
+        with Pool(n_workers, init_worker,
+                  (hog_params(hog), str(mode))) as pool:
+            chunksize = max(1, min(64, len(items) // (n_workers * 4)))
+            yield from instrument.results(
+                pool.imap(partial(instrument.call, function), items,
+                          chunksize))
+    else:
+        for item in items:
+            yield function(item, hog, mode)
+
+
+def digest_file(img_path, hog=None, mode=None):
+    return file_digest(img_path)
+
+
+def extract_features(images, hog, n_workers=1, mode=None):
+    yield from parallel_map(compute_features, images, hog, n_workers, mode)
+
+
+def image_paths(directory):
+    return [
+        name for name in map(str, pathlib.Path(directory).iterdir())
         if name.endswith('.jpg') or name.endswith('.png')
     ]
-    features_neg = []
-    features_pos = []
-    with alive_bar(len(negatives_images) + len(positives_images)) as bar:
-        suffix = (f'.{win_size[0]}x{win_size[1]}#{block_size[0]}x' +
-                  f'{block_size[1]}#{cell_size[0]}x{cell_size[1]}.npy')
-        for img_path in negatives_images:
-            data_path = pathlib.Path(f'{img_path}{suffix}')
-            if data_path.is_file():
-                features_neg.append(np.load(data_path))
-            else:
-                im = cv.imread(img_path)
-                assert (im is not None)
-                im = preprocess(im, win_size)
-                if im is not None:
-                    f = hog.compute(im)
-                    np.save(data_path, f)
-                    features_neg.append(f)
-                else:
-                    print(f'{img_path} ignored because is darker')
-            bar()
-
-        for img_path in positives_images:
-            data_path = pathlib.Path(f'{img_path}{suffix}')
-            if data_path.is_file():
-                features_pos.append(np.load(data_path))
+
+
+def load_features(negatives_path,
+                  positives_path,
+                  hog,
+                  n_workers=1,
+                  mode=None):
+    mode = mode or DecodeMode()
+    negatives_images = image_paths(negatives_path)
+    positives_images = image_paths(positives_path)
+    images = negatives_images + positives_images
+    store = FeatureStore(features_dir, hog, {
+        **preprocess_description(),
+        **mode.description()
+    })
+    with alive_bar(len(images)) as bar:
+        with instrument.span('digest'):
+            digests = list(parallel_map(digest_file, images, hog, n_workers))
+        missing = {}
+        for img_path, digest in zip(images, digests):
+            if digest in store or digest in missing:
+                bar()
             else:
-                im = cv.imread(img_path)
-                assert (im is not None)
-                im = preprocess(im, win_size)
-                if im is not None:
-                    f = hog.compute(im)
-                    np.save(data_path, f)
-                    features_pos.append(f)
-                else:
-                    print(f'{img_path} ignored because is darker')
-            bar()
-
-    return features_neg, features_pos
-
-
-def separate_datasets(features_neg, features_pos):
-    random.seed(0)
-    random.shuffle(features_neg)
-    random.shuffle(features_pos)
-
-    percent_cut = 0.75
-    train_neg_len = int(len(features_neg) * percent_cut)
-    train_pos_len = int(len(features_pos) * percent_cut)
-    train_data = []
-    train_labels = []
-    train_data.extend(f for f in features_neg[:train_neg_len])
-    train_data.extend(f for f in features_pos[:train_pos_len])
-    train_labels.extend(-1 for _ in range(train_neg_len))
-    train_labels.extend(1 for _ in range(train_pos_len))
-    assert (len(train_data) == len(train_labels))
-
-    test_data = []
-    test_labels = []
-    test_data.extend(f for f in features_neg[train_neg_len:])
-    test_data.extend(f for f in features_pos[train_pos_len:])
-    test_labels.extend(-1 for _ in range(len(features_neg) - train_neg_len))
-    test_labels.extend(1 for _ in range(len(features_pos) - train_pos_len))
-    assert (len(test_data) == len(test_labels))
-
-    return train_data, train_labels, test_data, test_labels
+                missing[digest] = img_path
+
+        missing_digests = []
+        missing_features = []
+        results = extract_features(list(missing.values()), hog, n_workers,
+                                   mode)
+        with instrument.span('extract_features'):
+            for digest, f in zip(missing, results):
+                missing_digests.append(digest)
+                missing_features.append(f)
+                if len(missing_features) == store_chunk:
+                    with instrument.span('store_append'):
+                        store.append(missing_digests, missing_features)
+                    missing_digests = []
+                    missing_features = []
+                bar()
+            with instrument.span('store_append'):
+                store.append(missing_digests, missing_features)
+        instrument.count('features_cached', len(images) - len(missing))
+        instrument.count('features_extracted', len(missing))
+
+    rows = []
+    labels = []
+    for i, (img_path, digest) in enumerate(zip(images, digests)):
+        row = store.row(digest)
+        if row < 0:
+            print(f'{img_path} ignored because is darker')
+        else:
+            rows.append(row)
+            labels.append(-1 if i < len(negatives_images) else 1)
+
+    with instrument.span('store_load'):
+        return Dataset.from_rows(store.matrix(), rows, labels, dataset_path)
 
 
 def summary_data(data, labels, title):
-    count_neg = 0
-    count_pos = 0
-    for label in labels:
-        if label == 1:
-            count_pos += 1
-        else:
-            count_neg += 1
+    count_pos = np.count_nonzero(labels == 1)
+    count_neg = len(labels) - count_pos
 
     print(f'{title} data:')
     print(f'{count_pos} positives examples.')
@@ -139,8 +185,81 @@ def setup_svm(C=0.1, gamma=1):
     return svm
 
 
+def timed_predict(model, data):
+    start = time.perf_counter()
+    result = model.predict(data)[1]
+    return result, time.perf_counter() - start
+
+
+def compare_models(reference, model, data, labels, title):
+    expected, reference_time = timed_predict(reference, data)
+    result, model_time = timed_predict(model, data)
+    agreement = np.count_nonzero(result == expected) * 100.0 / result.size
+    accuracy = np.count_nonzero(result == labels) * 100.0 / result.size
+    print(f'{title} results:')
+    print(f'Accurary: {accuracy:.2f}%')
+    print(f'Agreement with the exact model: {agreement:.2f}%')
+    print(f'Predict time: {model_time * 1000:.1f}ms ' +
+          f'(exact model {reference_time * 1000:.1f}ms)')
+    return agreement, accuracy
+
+
+def compare_projection(svm, projection, train_time, train_data, train_labels,
+                       test_data, test_labels):
+    # Searches and trains an SVM on the HOG features to report what the
+    # projection saves. Data is not projected. `train_time` is the time of
+    # the projection fit, search and training of `svm`.
+    print('Searching SVM parameters on the HOG features.')
+    start = time.perf_counter()
+    C, gamma = grid_search.search(train_data,
+                                  train_labels,
+                                  n_workers,
+                                  report_path=None)
+    plain = setup_svm(C=C, gamma=gamma)
+    plain.train(train_data, cv.ml.ROW_SAMPLE, train_labels)
+    plain_time = time.perf_counter() - start
+    plain_result, plain_predict_time = timed_predict(plain, test_data)
+    result, predict_time = timed_predict(ProjectedModel(projection, svm),
+                                         test_data)
+    plain_accuracy = np.count_nonzero(
+        plain_result == test_labels) * 100.0 / result.size
+    accuracy = np.count_nonzero(result == test_labels) * 100.0 / result.size
+    print('Projection results:')
+    print(f'Accurary: {accuracy:.2f}% (HOG features {plain_accuracy:.2f}%, ' +
+          f'{accuracy - plain_accuracy:+.2f} points)')
+    print('Search and train time: ' +
+          f'{train_time:.3f}s (HOG features {plain_time:.3f}s, ' +
+          f'{plain_time / max(train_time, 1e-9):.1f}x speedup)')
+    print(f'Predict time: {predict_time * 1000:.1f}ms (HOG features ' +
+          f'{plain_predict_time * 1000:.1f}ms, ' +
+          f'{plain_predict_time / max(predict_time, 1e-9):.1f}x speedup)')
+
+
+def compare_cascade(reference, cascade, data, labels):
+    expected, reference_time = timed_predict(reference, data)
+    result, cascade_time = timed_predict(cascade, data)
+    labels = np.ravel(labels)
+    result = np.ravel(result)
+    positives = max(1, np.count_nonzero(labels == 1))
+    recall = np.count_nonzero(result[labels == 1] == 1) * 100.0 / positives
+    exact_recall = np.count_nonzero(
+        np.ravel(expected)[labels == 1] == 1) * 100.0 / positives
+    accuracy = np.count_nonzero(result == labels) * 100.0 / result.size
+    print('Cascade results (thresholds calibrated on this data):')
+    print(f'Accurary: {accuracy:.2f}%')
+    print(f'Recall: {recall:.2f}% (exact model {exact_recall:.2f}%)')
+    print('Sent to the RBF model: ' +
+          f'{cascade.forwarded_fraction * 100:.1f}% of the samples')
+    print(f'Predict time: {cascade_time * 1000:.1f}ms (exact model ' +
+          f'{reference_time * 1000:.1f}ms, ' +
+          f'{reference_time / max(cascade_time, 1e-9):.1f}x speedup)')
+
+
 def train():
+    mode = DecodeMode.parse(decode_mode)
+    win_size, cell_size, block_size, block_stride = mode.geometry()
     print('HOG Info:')
+    print(f'Decode Mode: {mode}')
     print(f'Win Size: {win_size}')
     print(f'Cell Size: {cell_size}')
     print(f'Block Size: {block_size}')
@@ -148,41 +267,112 @@ def train():
     print(f'Num. Bins {n_bins}')
 
     hog = hog_setup(win_size, cell_size, n_bins, block_size, block_stride)
-    hog.save('models/hog_last_model.xml')
-
-    features_neg, features_pos = load_features('images/negatives',
-                                               'images/positives', hog)
+    hog_path = 'models/hog_last_model.xml'
+    hog.save(hog_path)
+    mode.save(hog_path)
 
-    train_data, train_labels, test_data, test_labels = separate_datasets(
-        features_neg, features_pos)
+    dataset = load_features('images/negatives', 'images/positives', hog,
+                            n_workers, mode)
+    train_data = dataset.train_data
+    train_labels = dataset.train_labels
+    test_data = dataset.test_data
+    test_labels = dataset.test_labels
 
     summary_data(train_data, train_labels, 'Training')
 
-    svm = setup_svm(C=1, gamma=1)
-
-    train_data = np.float32(train_data).reshape(-1, feature_len)
-    train_labels = np.int32(train_labels).reshape(-1, 1)
+    hog_train_data = train_data
+    hog_test_data = test_data
+    pca = None
+    start = time.perf_counter()
+    if projection is not None:
+        with instrument.span('projection_fit'):
+            pca = Projection.fit(train_data, pca_components, pca_variance,
+                                 projection == 'whiten')
+        if pca.n_components < feature_len:
+            print(f'Projection keeps {pca.n_components} of {feature_len} ' +
+                  f'components ({pca.retained_variance * 100:.1f}% of the ' +
+                  'variance)')
+            pca_path = 'models/pca_last_model.npz'
+            print(f'Saving projection at {pca_path}')
+            pca.save(pca_path)
+            train_data = pca.transform(train_data)
+        else:
+            print('Projection keeps every component, it is not used')
+            pca = None
+    print('Searching SVM parameters.')
+    report_path = 'models/svm_last_search.csv'
+    with instrument.span('grid_search'):
+        C, gamma = grid_search.search(train_data,
+                                      train_labels,
+                                      n_workers,
+                                      report_path=report_path)
+    search_time = time.perf_counter() - start
+    print(f'Best parameters: C={C:.6g} gamma={gamma:.6g}')
+    print(f'Search report saved at {report_path}')
+
+    svm = setup_svm(C=C, gamma=gamma)
     with alive_bar(1) as bar:
         print('Begin training.')
-        # svm.train(train_data, cv.ml.ROW_SAMPLE, train_labels)
-        svm.trainAuto(train_data, cv.ml.ROW_SAMPLE, train_labels)
+        start = time.perf_counter()
+        with instrument.span('svm_train'):
+            svm.train(train_data, cv.ml.ROW_SAMPLE, train_labels)
+        train_time = time.perf_counter() - start
         print('Training complete.')
         model_path = 'models/svm_last_model.dat'
         print(f'Saving model at {model_path}')
-        svm.save(model_path)
+        with instrument.span('svm_save'):
+            svm.save(model_path)
         bar()
 
     summary_data(test_data, test_labels, 'Test')
 
-    test_data = np.float32(test_data).reshape(-1, feature_len)
-    test_labels = np.int32(test_labels).reshape(-1, 1)
-    result = svm.predict(test_data)[1]
+    if pca is not None:
+        compare_projection(svm, pca, search_time + train_time,
+                           hog_train_data, train_labels, test_data,
+                           test_labels)
+        test_data = pca.transform(test_data)
+    with instrument.span('predict'):
+        result = svm.predict(test_data)[1]
     mask = result == test_labels
     correct = np.count_nonzero(mask)
     accuracy = correct * 100.0 / result.size
     print('Results:')
     print(f'Accurary: {accuracy:.2f}%')
 
+    with instrument.span('approx_fit'):
+        approx = NystroemSVM.fit(svm, approx_components)
+    approx_path = 'models/svm_last_approx.npz'
+    print(f'Saving approximated model at {approx_path}')
+    approx.save(approx_path)
+    compare_models(svm, approx, test_data, test_labels,
+                   f'Nystroem ({len(approx.vectors)} landmarks)')
+
+    with instrument.span('reduce_fit'):
+        reduced = reduce_svm(svm, train_data, train_labels, reduced_size,
+                             reduced_accuracy_loss, reduced_float16)
+    reduced_path = 'models/svm_last_reduced.npz'
+    print(f'Saving reduced model at {reduced_path}')
+    reduced.save(reduced_path)
+    n_support_vectors = len(svm.getSupportVectors())
+    compare_models(
+        svm, reduced, test_data, test_labels,
+        f'Reduced ({len(reduced.vectors)} of {n_support_vectors} ' +
+        'support vectors)')
+    print(f'Model size: {os.path.getsize(reduced_path) / 1024:.0f}KiB ' +
+          f'(exact model {os.path.getsize(model_path) / 1024:.0f}KiB)')
+
+    # The prefilter scores HOG features, before any projection
+    with instrument.span('prefilter_fit'):
+        prefilter = LinearPrefilter.fit(hog_train_data, train_labels,
+                                        prefilter_C)
+        prefilter.calibrate(hog_test_data, test_labels, cascade_recall)
+    prefilter_path = 'models/svm_last_prefilter.npz'
+    print(f'Saving linear prefilter at {prefilter_path}')
+    prefilter.save(prefilter_path)
+    reference = svm if pca is None else ProjectedModel(pca, svm)
+    compare_cascade(reference, CascadeModel(prefilter, reference),
+                    hog_test_data, test_labels)
+
 
 if __name__ == '__main__':
     train()